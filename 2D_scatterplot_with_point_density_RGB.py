@@ -9,7 +9,9 @@ from pci.api import datasource as ds
 import numpy as np
 import matplotlib.pyplot as plt
 from scipy.stats import gaussian_kde
-import csv
+
+from point_density_tools import binned_density, neighbour_density
+from scatter_data_tools import read_channel_pairs, read_csv_columns, valid_pairs_mask
 
 # ----------------------------------------------------------------------------------------------------------------------
 # User defined variables
@@ -17,6 +19,8 @@ import csv
 # A) I/O options
 input_type = "text"                                              # Valid options are "raster" or "text"
 text_csv_header = "yes"                                            # Valid options are "yes" or "no"
+# Reads the CSV values as 32 bit floats (half the memory of the default 64 bit floats)
+text_float32 = "no"                                                # Valid options are "yes" or "no"
 
 input_file = r"D:\HBL_3MAPS_regression_rates\20241119_attempt_3\20241119_Stats_2010_2017_2024_min_100_n=13714_no_div0.csv"
 x_axis_int = 10
@@ -25,6 +29,16 @@ y_axis_int = 12
 #input_file = r"D:\HBL_Palsa_Mapping_regional\small_Landsat_test.pix"
 #x_axis_int = 1
 #y_axis_int = 2
+# Raster input: only the x_axis_int and y_axis_int channels are read, raster_block_lines lines at a time
+raster_block_lines = 1024
+
+# Filtering of the points (both input types). With raster input, the pixels where either channel
+# is NoData are always removed from both axes.
+# Removal of the NaN and infinite values
+remove_nan = "yes"                                                 # Valid options are "yes" or "no"
+# Only the points inside the ranges are kept, e.g. x_axis_range = (0, 15); None = no limit
+x_axis_range = None
+y_axis_range = None
 
 ## B) 2D Plots options
 # Reducing the number of points for faster rendering of the 2D scatter plot
@@ -32,6 +46,22 @@ y_axis_int = 12
 apply_point_reduction = "no"                               # Valid options are "yes" or "no"
 number_of_points = 20000
 
+# Point density used to colour the points
+#   "kde"    : scipy gaussian_kde, every point evaluated against every point (see the notes below)
+#   "binned" : same Gaussian kernel computed on a density_grid_size x density_grid_size grid and
+#              interpolated back at every point. Linear in the number of points, so all the points
+#              can be coloured without apply_point_reduction.
+#   "knn"    : density from the distance to the density_neighbours-th nearest neighbour of every
+#              point (KD-tree, O(n log n)). Keeps the sharp features that the kernel blurs.
+#   "radius" : density from the number of points within density_radius (in standard deviations
+#              of the data) of every point (KD-tree).
+density_method = "kde"                                 # Valid options are "kde", "binned", "knn" or "radius"
+density_grid_size = 512
+density_neighbours = 32
+density_radius = 0.05
+# Number of parallel processes for the KD-tree queries, -1 = all the CPUs
+density_workers = -1
+
 # Calculate and add a regression line to the 2D scatter plot
 display_regression_line = "NO"                                           # Valid options are "yes" or "no"
 polynomial_order = 1
@@ -52,6 +82,7 @@ display_scatter_plot = "yes"
  *Number of samples for displaying and saving data. 
   10 000 samples is fast.
   20 000 samples is manageable. 
+  (with density_method = "kde"; "binned" handles millions of samples)
 '''
 
 
@@ -101,6 +132,15 @@ if input_type == "text":
         remove_header = True 
     else:   
         remove_header = False
+
+    text_float32 = text_float32.lower()
+    if text_float32 not in yes_no_validation_list: 
+        print ('Error !  text_float32 must be set with "yes" or "no"')
+        sys.exit()
+    elif text_float32 in yes_validation_list: 
+        csv_dtype = np.float32
+    else: 
+        csv_dtype = np.float64
 else: 
     input_csv_text = False
 
@@ -123,6 +163,20 @@ else:
     x_axis_int = x_axis_int - 1
     y_axis_int = y_axis_int - 1
 
+remove_nan = remove_nan.lower()
+if remove_nan not in yes_no_validation_list: 
+    print ('Error !  remove_nan must be set with "yes" or "no"')
+    sys.exit()
+elif remove_nan in yes_validation_list: 
+    remove_nan = True
+else: 
+    remove_nan = False
+
+for axis_range in (x_axis_range, y_axis_range):
+    if axis_range is not None and (len(axis_range) != 2 or axis_range[0] > axis_range[1]):
+        print ("Error ! - x_axis_range and y_axis_range must be None or (min, max) with min <= max")
+        sys.exit()
+
 # B) 2D Plots options
 apply_point_reduction = apply_point_reduction.lower()
 if apply_point_reduction not in yes_no_validation_list:
@@ -135,6 +189,24 @@ else:
 
 # Add check for number of points here
 
+density_method = density_method.lower()
+if density_method not in ["kde", "binned", "knn", "radius"]:
+    print ('Error !  density_method must be "kde", "binned", "knn" or "radius"')
+    sys.exit()
+elif density_method == "binned":
+    if int(density_grid_size) != density_grid_size or density_grid_size < 8:
+        print ("Error ! - density_grid_size must be an integer >= 8")
+        sys.exit()
+    density_grid_size = int(density_grid_size)
+elif density_method == "knn":
+    if int(density_neighbours) != density_neighbours or density_neighbours < 1:
+        print ("Error ! - density_neighbours must be an integer >= 1")
+        sys.exit()
+elif density_method == "radius":
+    if density_radius <= 0:
+        print ("Error ! - density_radius must be > 0")
+        sys.exit()
+
 display_regression_line = display_regression_line.lower()
 if display_regression_line not in yes_no_validation_list: 
         print ('Error !  Display_regression_line must be set with "yes" or "no"')
@@ -171,47 +243,30 @@ if input_raster is True:
 
     with ds.open_dataset(input_file) as ds1:
 
-        # Read raster data
-        reader = ds.BasicReader(ds1)
-        raster = reader.read_raster(0, 0, reader.width, reader.height)
-
-
-        x_axis_data = raster.data[:, :, x_axis_int]
-        x_axis_data = x_axis_data.reshape(-1)
-
-        y_axis_data = raster.data[:, :, y_axis_int]
-        y_axis_data = y_axis_data.reshape(-1)
-
         print ("\t")
         print ("Input file: " + input_file)
-        print("Number of Pixels (X)  and Lines (Y): " + str (reader.width) + ", " + str (reader.height))
+        print("Number of Pixels (X)  and Lines (Y): " + str (ds1.width) + ", " + str (ds1.height))
 
         # Read the metadata to retrieve the NoDataValue at the File Level
         aux = ds1.aux_data
         nodata = aux.get_file_metadata_value('NO_DATA_VALUE')
         print ("No Data value is " + str(nodata))
 
-    # Removing the NoData value from the array. There is no removal of NANs
-    # (if needed,  look the code in s4A_PSI_INSPSC. for removing NANs)
-    original_lenght = len(x_axis_data)
-    x_axis_data = np.delete(x_axis_data, np.where(x_axis_data == float(nodata)))
+    # Only the two channels are read, block by block. The pixels where either channel is NoData
+    # (and the NaN / out of range values) are removed from both axes with one mask per block.
+    x_axis_data, y_axis_data, original_lenght, nodata_counts = read_channel_pairs(input_file,
+                                                                                 [x_axis_int + 1, y_axis_int + 1],
+                                                                                 float(nodata), raster_block_lines,
+                                                                                 remove_nan, x_axis_range,
+                                                                                 y_axis_range)
     x_array_lenght = len(x_axis_data)
-    y_axis_data = np.delete(y_axis_data, np.where(y_axis_data == float(nodata)))
-    y_array_lenght = len(y_axis_data)
-
-    # Quality control check
-    if x_array_lenght != y_array_lenght:
-        print ("Error - X and Y axis doesn't have the same amount of NoDataValue")
-        print("X axis number of samples: " + str(x_array_lenght))
-        print("Y axis number of samples: " + str(y_array_lenght))
-        sys.exit()
-    else:
-        No_NoData  = original_lenght - x_array_lenght
+    No_NoData  = original_lenght - x_array_lenght
 
-        print ("Number of original samples: " + str (original_lenght))
-        print ("Number of No Data Value removed: " + str(No_NoData))
-        final_samples_pct = str(round (((original_lenght - No_NoData) / original_lenght) * 100, 2))
-        print ("Final number of samples: " + str(x_array_lenght) + " ("+ final_samples_pct +"%)")
+    print ("Number of original samples: " + str (original_lenght))
+    print ("Number of No Data Value (X axis, Y axis): " + str(nodata_counts[0]) + ", " + str(nodata_counts[1]))
+    print ("Number of samples removed: " + str(No_NoData))
+    final_samples_pct = str(round (((original_lenght - No_NoData) / original_lenght) * 100, 2))
+    print ("Final number of samples: " + str(x_array_lenght) + " ("+ final_samples_pct +"%)")
 
 # Reading and parsing the CSV file
 if input_csv_text is True:
@@ -219,31 +274,21 @@ if input_csv_text is True:
     print("\t")
     print((time.strftime("%H:%M:%S")) + "... Reading the input CSV file")
 
-    x_axis_csv = []
-    y_axis_csv = []
-
-    with open(input_file, 'r') as csvfile:
-        plots = csv.reader(csvfile, delimiter=',')
-
-        for row in plots:
-            x_axis_csv.append(row[x_axis_int])
-            y_axis_csv.append(row[y_axis_int])
-
-    if remove_header is True:
-        x_axis_csv.pop(0)
-        y_axis_csv.pop(0)
+    # Only the two columns are parsed, directly to float arrays
+    x_axis_data, y_axis_data = read_csv_columns(input_file, (x_axis_int, y_axis_int), remove_header, csv_dtype)
+    original_lenght = len(x_axis_data)
 
-    csv_x_axis_data = []
-    csv_y_axis_data = []
-    for ii, jj in zip(x_axis_csv, y_axis_csv): 
-        
-        kk=float(ii)
-        ll=float(jj)
-        csv_x_axis_data.append(kk)
-        csv_y_axis_data.append(ll)
+    # The NaN and out of range values are removed from both axes with one mask
+    valid = valid_pairs_mask(x_axis_data, y_axis_data, None, remove_nan, x_axis_range, y_axis_range)
+    if not valid.all():
+        x_axis_data = x_axis_data[valid]
+        y_axis_data = y_axis_data[valid]
+    x_array_lenght = len(x_axis_data)
 
-    x_axis_data = np.asarray(csv_x_axis_data)
-    y_axis_data = np.asarray(csv_y_axis_data)
+    print ("\t")
+    print ("Input file: " + input_file)
+    print ("Number of samples: " + str(original_lenght))
+    print ("Number of samples removed (NaN or out of range): " + str(original_lenght - x_array_lenght))
 
 '''
 print (str(len(x_axis_data)))
@@ -347,8 +392,15 @@ print ("  Sampled data size: " + sample_size)
 
 # Calculate the point density
 print ("   " + (time.strftime("%H:%M:%S")) + "...Calculating the points density")
-xy = np.vstack([x,y])
-z = gaussian_kde(xy)(xy)
+if density_method == "binned":
+    z = binned_density(x, y, density_grid_size)
+elif density_method == "knn":
+    z = neighbour_density(x, y, neighbours=density_neighbours, workers=density_workers)
+elif density_method == "radius":
+    z = neighbour_density(x, y, radius=density_radius, workers=density_workers)
+else:
+    xy = np.vstack([x,y])
+    z = gaussian_kde(xy)(xy)
 # Sort the points by density, so that the densest points are plotted last
 idx = z.argsort()
 x, y, z = x[idx], y[idx], z[idx]
@@ -15,13 +15,20 @@ locale.setlocale(locale.LC_NUMERIC, "C")
 import os, glob, fnmatch, sys, time
 
 from pci.api import datasource as ds
+from pci.api import gobs
 from pci.clip import clip
-from pci.thr import thr
-from pci.model import model
 from pci.exceptions import *
 from pci.exceptions import PCIException
 import numpy as np
 
+from confusion_matrix_tools import confusion_matrix, class_detail_lines, confusion_matrix_lines
+from confusion_matrix_tools import compact_matrix, nodata_mask, parallel_confusion
+from confusion_matrix_tools import count_rows, layer_pairs, transition_table_lines
+from confusion_matrix_tools import agreement_metrics_lines, pair_table_lines, DenseMatrixError
+from raster_block_io import create_raster_file, geocoding_transform
+from table_output_tools import table_format_list, write_matrix, write_table
+from vector_mask_tools import spans_to_mask, subset_mask_spans
+
 
 start = time.time()
 # -----------------------------------------------------------------------------------------------------
@@ -31,14 +38,21 @@ start = time.time()
 The aim of the script is to compare two thematic classifications by computing a frequency matrix. 
     1)	The unique values of the first classification (classif_layer_1) are found and stored in an array. 
     2)	The unique values of the second classification (classif_layer_2) are found and stored in an array.
-    3)	For the first unique value of the classif_layer_1, the frequency of all unique values of the second 
-         classification are computed. 
-    4)	The result is stored in a text file.
-    5)	Redo steps 3 and 4 for every unique value in the array of classif_layer_1
+    3)	Every pixel pair is encoded into one combined index and the whole frequency matrix is 
+         computed with a single np.bincount (see confusion_matrix_tools.py).
+    4)	For every unique value of the classif_layer_1, the frequency of all unique values of the second 
+         classification is read from the matrix.
+    5)	The result is stored in a text file.
 Requirements: 
     1) The two thematic classifications must be stored in the same pix file. 
-    2) The two thematic classifications must be in 8 bit. 
-    3) If remove_nodata = True , only the common area will be process
+    2) The two thematic classifications must be in 8 bit. For high cardinality layers (e.g. 
+        segment IDs), use sparse_classes = 'yes': a long-format table of the pairs of classes 
+        found replaces the frequency matrix.
+    3) If apply_common_nodata = True , only the common area will be process (pixels where neither 
+        layer is NoData). The joint NoData mask is built in memory while reading.
+    4) Additional thematic layers (additional_classif_layers) are read in the same raster pass and
+        every pair of layers gets its own frequency matrix file. With more than two layers, the 
+        common area excludes the pixels where any of the layers is NoData.
 
 '''
 # ----------------------------------------------------------------------------------------------
@@ -49,6 +63,13 @@ Requirements:
 input_file = r'D:\HBL_Palsas_classif\Database_merge.pix'
 classif_layer_1 = 11
 classif_layer_2 = 9
+# Additional thematic layers (channels) compared in the same raster pass, e.g. [5, 7].
+# Requires block_processing = 'yes'. With more than two layers, every pair of layers is written
+# to its own file: <output_file_name>_ch<a>_ch<b>.txt
+additional_classif_layers = []
+# Multi-way transition table (one line per combination of classes of all the layers), written to
+# <output_file_name>_transitions.txt - available options are 'yes' or 'no'
+write_transition_table = 'no'
 
 # available options are 'yes' or 'no'
 apply_common_nodata = 'yes'
@@ -58,375 +79,540 @@ nodata_value = 0
 subset_data = 'no'
 subset_vector_file = r"D:\HBL_Palsas_classif\clip_layer_test2.pix"
 subset_segment = 2
+# With direct_read = 'yes', the subset polygons are rasterized in memory and only the pixels
+# inside the polygons are processed. The rasterized polygons can be cached (in the folder
+# subset_mask_cache_folder) and reused by the next runs with the same subset vector file and
+# raster geocoding. The cache files are not deleted. Available options are 'yes' or 'no'
+subset_mask_cache = 'no'
+# None = a subset_mask_cache folder next to input_file
+subset_mask_cache_folder = None
 
 output_file_name = "Palsa_classif_compare_full.txt"
 
+# Agreement metrics - available options are 'yes' or 'no'
+# Overall agreement, kappa, quantity and allocation disagreement and the per class producer and
+# user agreement (layer 1 as reference) are computed from the frequency matrix and written next
+# to every matrix file, as <matrix file name>_metrics.txt
+write_agreement_metrics = 'no'
+# Bootstrap confidence intervals of the metrics, by multinomial resampling of the matrix.
+# bootstrap_samples = 0 means no confidence interval.
+bootstrap_samples = 0
+bootstrap_confidence = 95
+
+# Transition raster - available options are 'yes' or 'no'
+# From-to change map of classif_layer_1 to classif_layer_2, coded
+#   classif_layer_1 * transition_factor + classif_layer_2 (32 bit signed)
+# written block by block during the comparison pass to <output_file_name>_change_map.pix.
+# The pixels that are not compared (NoData, outside the subset polygons) are set to 0.
+# Requires block_processing = 'yes'. transition_factor must be greater than the classes of
+# classif_layer_2.
+write_transition_raster = 'no'
+transition_factor = 1000
+
+# Direct read - available options are 'yes' or 'no'
+# The two thematic layers are read directly from input_file, over the pixel window of the
+# subset vector extents (or the whole image), instead of being clipped to an intermediate
+# <prefix>_<base>.pix file. The subset vector file must then be in the coordinate system of
+# input_file (it is not reprojected, unlike with CLIP).
+direct_read = 'yes'
+
+# Block processing - available options are 'yes' or 'no'
+# The two thematic layers are read window by window (block_lines lines at a time) and the
+# counts of every block are added to a running matrix. The file is read only once and the
+# memory use is bounded by the block size. Requires non-negative integer thematic layers: use
+# sparse_classes = 'yes' or block_processing = 'no' for float, negative or high cardinality layers.
+block_processing = 'yes'
+block_lines = 1024
+# Number of worker processes for block processing. The image is split into row bands that are
+# read and counted in parallel; the partial matrices are summed at the end. 1 = no worker pool.
+workers = 1
+
+# Sparse mode for high cardinality layers (e.g. segment IDs) - available options are 'yes' or 'no'
+# Instead of the frequency matrix, the output file holds a long-format table (layer1;layer2;count)
+# of the pairs of classes found. No agreement metrics are computed in this mode.
+sparse_classes = 'no'
+
+# Columnar outputs of the frequency matrices (or the tables of the pairs of classes in sparse
+# mode) and of the transition table, written from the numpy arrays next to the text files:
+# 'npz' (<file>.npz, read with np.load), 'npy' (<file>_npy folder with one .npy file per array,
+# that can be memory-mapped with np.load(..., mmap_mode="r")) and 'csv' (<file>.csv).
+# e.g. table_formats = ['npz', 'csv']
+table_formats = []
+
 delete_if_exist = True
 # ---------------------------------------------------------------------------------------------
 #  Main program
 # ----------------------------------------------------------------------------------------------
 #
-yes_validation_list = ["yes", "y", "yse", "ys"]
-
-
-# A ) Conformity  check
-if apply_common_nodata.lower() in yes_validation_list:
-    apply_common_nodata = True
-else:
-    apply_common_nodata = False
-
-if subset_data.lower() in yes_validation_list:
-    subset_data = True
-    if not os.path.exists(subset_vector_file):
-        print ("Error - The subset_vector_file does not exists or the path is wrong")
+# The main program is guarded because the worker processes (workers > 1) import this script.
+if __name__ == "__main__":
+    yes_validation_list = ["yes", "y", "yse", "ys"]
+
+
+    # A ) Conformity  check
+    if apply_common_nodata.lower() in yes_validation_list:
+        apply_common_nodata = True
+    else:
+        apply_common_nodata = False
+
+    if subset_data.lower() in yes_validation_list:
+        subset_data = True
+        if not os.path.exists(subset_vector_file):
+            print ("Error - The subset_vector_file does not exists or the path is wrong")
+            sys.exit()
+    else:
+        subset_data = False
+
+    if subset_mask_cache.lower() in yes_validation_list:
+        subset_mask_cache = True
+    else:
+        subset_mask_cache = False
+
+    if direct_read.lower() in yes_validation_list:
+        direct_read = True
+    else:
+        direct_read = False
+
+    if block_processing.lower() in yes_validation_list:
+        block_processing = True
+        if int(block_lines) != block_lines or block_lines < 1:
+            print ("Error - block_lines must be an integer >= 1")
+            sys.exit()
+    else:
+        block_processing = False
+
+    if int(workers) != workers or workers < 1:
+        print ("Error - workers must be an integer >= 1")
+        sys.exit()
+    elif workers > 1 and block_processing is False:
+        print ("Error - workers > 1 requires block_processing = 'yes'")
         sys.exit()
-else:
-    subset_data = False
-
-# --------------------------------------------------------------------------------------------------------------------
-#B)  Data preprocessing
-# --------------------------------------------------------------------------------------------------------------------
-print("\t")
-output_line = ((time.strftime("%H:%M:%S")) + " Data preprocessing")
-print (output_line)
-output_line = ((time.strftime("%H:%M:%S")) + " Extracting the thematic layers form the main database (data_copy)")
-print (output_line)
-
-base = os.path.basename(input_file)
-prefix = (output_file_name[:-4] + "_")
-output_folder = os.path.dirname(input_file)
-clip_out = os.path.join(output_folder, prefix + base)
-
-fili = input_file
-print (fili)
-dbic = [classif_layer_1, classif_layer_2]
-dbsl = []
-sltype = ""
-filo = clip_out
-print (filo)
-ftype = "PIX"
-foptions = ""
-
-if subset_data is True:
-    print ("here_1")
-    clipmeth = "LAYERVEC"
-    clipfil = subset_vector_file
-    cliplay = [subset_segment]
-    laybnds = "SHAPES"
-else:
-    print ("here_2")
-    clipmeth = "FILE"
-    clipfil = input_file
-    cliplay = [1]
-    laybnds = "EXTENTS"
-
-coordtyp = ""
-clipul = ""
-cliplr = ""
-clipwh = ""
-initvalu = [0]
-setnodat = "Y"
-oclipbdy = "N"
-
-# check if filo exists
-if os.path.exists(filo) == True and delete_if_exist == True:
-    os.remove(filo)
-
-try:
-    clip(fili, dbic, dbsl, sltype, filo, ftype,
-         foptions, clipmeth, clipfil, cliplay,
-         laybnds, coordtyp, clipul, cliplr,
-         clipwh, initvalu, setnodat, oclipbdy)
-except PCIException as e:
-    print(e)
-except Exception as e:
-    print(e)
-
-input_file = filo
-
-# -----------------------------------------------------------------------------------------------------------------------
-# Quick check for the presence of NoData values for both channels:
-with ds.open_dataset(filo) as ds5:
-    reader = ds.BasicReader(ds5)
-    # read the raster channels
-    raster = reader.read_raster(0, 0, reader.width, reader.height)
-
-    layer_1 = raster.data[:, :, (0)]
-    layer_2 = raster.data[:, :, (1)]
-
-    layer_1_rsp = layer_1.reshape(-1)
-    layer_2_rsp = layer_2.reshape(-1)
-
-    layer_1_nval = np.delete(layer_1_rsp, np.where(layer_1_rsp == nodata_value))
-    layer_2_nval = np.delete(layer_2_rsp, np.where(layer_2_rsp == nodata_value))
-
-    layer_1_nodata = len(layer_1_rsp) - len(layer_1_nval)
-    layer_1_nval_pct = round((layer_1_nodata / (reader.width * reader.height)) * 100,2)
-    layer_2_nodata = len(layer_2_rsp) - len(layer_2_nval)
-    layer_2_nval_pct = round((layer_2_nodata / (reader.width * reader.height)) * 100,2)
-
-    print ("Number of NoData values in layer 1 : " + str(layer_1_nodata) + " (" + str (layer_1_nval_pct) + "%)")
-    print ("Number of NoData values in layer 2 : " + str(layer_2_nodata) + " (" + str (layer_2_nval_pct) + "%)")
-
-
-if apply_common_nodata is True:
-    print ("\t")
-    output_line = ((time.strftime("%H:%M:%S")) + " Creating the common NoData values bitmap")
-    print(output_line)
-
-    file = filo
-    dbic = [1]
-    dbob = []
-    tval = [nodata_value, nodata_value]
-    comp = 'off'
-    dbsn = 'NoData'
-    dbsd = 'NoDataVal'
-
-    thr( file, dbic, dbob, tval, comp, dbsn, dbsd )
-
-
-    # Write an output EASI model file for the second thematic layer.
-    outeasi_list = []
-    outeasi = ("if %2 = " + str(nodata_value) + " then")
-    outeasi_list.append(outeasi)
-    outeasi = "%%2 = 1"
-    outeasi_list.append(outeasi)
-    outeasi = "endif"
-    outeasi_list.append(outeasi)
-
-    outeasi = "if %%2 = 1 then"
-    outeasi_list.append(outeasi)
-    outeasi = ("%1 ="  + str(nodata_value))
-    outeasi_list.append(outeasi)
-    outeasi = ("%2 =" + str(nodata_value))
-    outeasi_list.append(outeasi)
-    outeasi = "endif"
-    outeasi_list.append(outeasi)
-
-    file1 = os.path.join(output_folder, "easi_model.txt")
-    with open(file1, "w") as f:
-        f.write("\n".join(outeasi_list))
-
-    output_line = ((time.strftime("%H:%M:%S")) + " Applying the EASI model to set the NoData")
-    print(output_line)
-    file = filo
-    source = file1
-    undefval = []
-    model(file, source, undefval)
-
-
-# --------------------------------------------------------------------------------------------------------------------
-# C)  Find the unique values
-# --------------------------------------------------------------------------------------------------------------------
-
-new_line = ("\t")
-output_folder = os.path.dirname(input_file)
-output_file_lines = []
-file = os.path.join(output_folder, output_file_name)
-
-# A ) Open input file
-print("\t")
-output_line = ((time.strftime("%H:%M:%S")) + " Reading the input raster file")
-print (output_line)
-output_file_lines.append(output_line)
-
-with ds.open_dataset(input_file, ds.eAM_READ) as ds2:
-    aux = ds2.aux_data
-    num_cols = ds2.width
-    num_rows = ds2.height
-    num_channels = ds2.chan_count
-    ref_crs = ds2.crs  # coordinate system
-    ref_geocoding = ds2.geocoding  # Geocoding
-
-    output_line = ("Input raster: " + input_file)
-    print (output_line)
-    output_file_lines.append(output_line)
-
-    output_line =("  X - Number of columns (pixels): " + str(num_cols))
-    print (output_line)
-    output_file_lines.append(output_line)
 
-    output_line = ("  Y - Number of rows (lines): " + str(num_rows))
-    print (output_line)
-    output_file_lines.append(output_line)
+    classif_layers = [classif_layer_1, classif_layer_2] + list(additional_classif_layers)
+    if len(set(classif_layers)) != len(classif_layers):
+        print ("Error - the same channel is listed more than once in the thematic layers")
+        sys.exit()
+    elif len(classif_layers) > 2 and block_processing is False:
+        print ("Error - additional_classif_layers requires block_processing = 'yes'")
+        sys.exit()
 
-    output_line = ("Number of channels: " + str(num_channels))
+    if write_transition_table.lower() in yes_validation_list:
+        write_transition_table = True
+    else:
+        write_transition_table = False
+
+    if write_transition_raster.lower() in yes_validation_list:
+        write_transition_raster = True
+        if block_processing is False:
+            print ("Error - write_transition_raster requires block_processing = 'yes'")
+            sys.exit()
+        if int(transition_factor) != transition_factor or transition_factor < 1:
+            print ("Error - transition_factor must be an integer >= 1")
+            sys.exit()
+    else:
+        write_transition_raster = False
+
+    if sparse_classes.lower() in yes_validation_list:
+        sparse_classes = True
+    else:
+        sparse_classes = False
+
+    for table_format in table_formats:
+        if table_format not in table_format_list:
+            print ("Error - table_formats must be in " + str(table_format_list))
+            sys.exit()
+
+    if write_agreement_metrics.lower() in yes_validation_list and sparse_classes is False:
+        write_agreement_metrics = True
+        if int(bootstrap_samples) != bootstrap_samples or bootstrap_samples < 0:
+            print ("Error - bootstrap_samples must be an integer >= 0")
+            sys.exit()
+        if not 0 < bootstrap_confidence < 100:
+            print ("Error - bootstrap_confidence must be between 0 and 100")
+            sys.exit()
+    else:
+        write_agreement_metrics = False
+
+    # --------------------------------------------------------------------------------------------------------------------
+    #B)  Data preprocessing
+    # --------------------------------------------------------------------------------------------------------------------
+    print("\t")
+    output_line = ((time.strftime("%H:%M:%S")) + " Data preprocessing")
     print (output_line)
 
-    print (new_line)
-    output_file_lines.append(new_line)
-
-
-#B) Find the uniques values for both input layer
-print("\t")
-output_line = ((time.strftime("%H:%M:%S")) + " Finding the uniques values for both thematic rasters")
-print (output_line)
-output_file_lines.append(output_line)
-
-with ds.open_dataset(input_file) as ds3:
-    reader = ds.BasicReader(ds3)
-    # read the raster channels
-    raster = reader.read_raster(0, 0, reader.width, reader.height)
-
-    layer_1 = raster.data[:, :, (0)]
-    layer_2 = raster.data[:, :, (1)]
-
-    if apply_common_nodata is True:
-        print ("Ataboy")
-        layer_1_rsp = layer_1.reshape(-1)
-        layer_2_rsp = layer_2.reshape(-1)
-        layer_1_nval = np.delete(layer_1_rsp, np.where(layer_1_rsp == nodata_value))
-        layer_2_nval = np.delete(layer_2_rsp, np.where(layer_1_rsp == nodata_value))
-        print("Size of layer 1 after NoData removal: " + str(len(layer_1_nval)))
-        print("Size of layer 2 after NoData removal: " + str(len(layer_2_nval)))
-        layer_1 = layer_1_nval
-        layer_2 = layer_2_nval
-
-
-    print ("here5")
-    unique_1, frequency_1 = np.unique(layer_1, return_counts = True)
-    unique_2, frequency_2 = np.unique(layer_2, return_counts = True)
-    print ("here6")
-
-
-# print unique values array
-tempuniq = str(unique_1)
-output_line = (" Unique Values (classif_layer_1) :" + tempuniq)
-print (output_line)
-output_file_lines.append(output_line)
-tempuniq = str(unique_2)
-output_line = (" Unique Values (classif_layer_2) :" + tempuniq)
-print (output_line)
-output_file_lines.append(output_line)
-
-# print frequency array
-tempfreq = str(frequency_1)
-output_line = (" Frequency Values (classif_layer_1): " + tempfreq)
-print (output_line)
-output_file_lines.append(output_line)
-tempfreq = str(frequency_2)
-output_line = (" Frequency Values (classif_layer_2): "+ tempfreq)
-print (output_line)
-output_file_lines.append(output_line)
-
-# Verification to check if there is the same number of pixels in both frequency
-sum_layer_1 = np.sum(frequency_1)
-sum_layer_2 = np.sum(frequency_2)
-
-if sum_layer_1 != sum_layer_2 :
-    print (" Error - the sum of pixels for both layer is not the same")
-    sys.exit()
-else :
-    output_line = (" Pixels count for layer 1: " + str(sum_layer_1))
-    output_file_lines.append(output_line)
-    print (output_line)
-    output_line = (" Pixels count for layer 1: " + str(sum_layer_2))
-    output_file_lines.append(output_line)
-    print (output_line)
+    base = os.path.basename(input_file)
+    prefix = (output_file_name[:-4] + "_")
+    output_folder = os.path.dirname(input_file)
+    clip_out = os.path.join(output_folder, prefix + base)
+
+    if direct_read is True:
+        output_line = ((time.strftime("%H:%M:%S")) + " Reading the thematic layers directly from the main database")
+        print (output_line)
+        read_file = input_file
+        read_channels = classif_layers
+
+        subset_spans = None
+        with ds.open_dataset(input_file, ds.eAM_READ) as ds1:
+            read_window = (0, 0, ds1.width, ds1.height)
+            if subset_data is True:
+                # Window of the subset extents and rasterized subset polygons
+                cache_folder = None
+                if subset_mask_cache is True:
+                    cache_folder = subset_mask_cache_folder or os.path.join(output_folder, "subset_mask_cache")
+                try:
+                    read_window, subset_spans = subset_mask_spans(subset_vector_file, subset_segment,
+                                                                  geocoding_transform(ds1), ds1.width,
+                                                                  ds1.height, cache_folder, ds1.crs)
+                except ValueError as e:
+                    print ("Error - " + str(e))
+                    sys.exit()
+                if read_window is None:
+                    print ("Error - The subset vector layer does not overlap the input_file")
+                    sys.exit()
+
+        print ("Pixel window (x, y, width, height): " + str(read_window))
+
+    else:
+        output_line = ((time.strftime("%H:%M:%S")) + " Extracting the thematic layers form the main database (data_copy)")
+        print (output_line)
+
+        fili = input_file
+        print (fili)
+        dbic = classif_layers
+        dbsl = []
+        sltype = ""
+        filo = clip_out
+        print (filo)
+        ftype = "PIX"
+        foptions = ""
+
+        if subset_data is True:
+            print ("here_1")
+            clipmeth = "LAYERVEC"
+            clipfil = subset_vector_file
+            cliplay = [subset_segment]
+            laybnds = "SHAPES"
+        else:
+            print ("here_2")
+            clipmeth = "FILE"
+            clipfil = input_file
+            cliplay = [1]
+            laybnds = "EXTENTS"
+
+        coordtyp = ""
+        clipul = ""
+        cliplr = ""
+        clipwh = ""
+        initvalu = [0]
+        setnodat = "Y"
+        oclipbdy = "N"
+
+        # check if filo exists
+        if os.path.exists(filo) == True and delete_if_exist == True:
+            os.remove(filo)
+
+        try:
+            clip(fili, dbic, dbsl, sltype, filo, ftype,
+                 foptions, clipmeth, clipfil, cliplay,
+                 laybnds, coordtyp, clipul, cliplr,
+                 clipwh, initvalu, setnodat, oclipbdy)
+        except PCIException as e:
+            print(e)
+        except Exception as e:
+            print(e)
+
+        input_file = filo
+
+        read_file = filo
+        read_channels = list(range(1, len(classif_layers) + 1))
+        read_window = None
+        subset_spans = None
+
+    # -----------------------------------------------------------------------------------------------------------------------
+    # Quick check for the presence of NoData values for both channels:
+    if block_processing is True:
+        # Single streaming pass: the counts of every block are added to a running matrix indexed
+        # by the class values. The joint NoData mask is applied to every block before counting.
+        print ("\t")
+        output_line = ((time.strftime("%H:%M:%S")) + " Reading the thematic layers block by block")
+        print (output_line)
+
+        if workers > 1:
+            output_line = ("Number of worker processes: " + str(workers))
+            print (output_line)
+
+        # The change map has the size and geocoding of the file read; it is filled during the pass.
+        transition_file = None
+        if write_transition_raster is True:
+            transition_file = os.path.join(output_folder, output_file_name[:-4] + "_change_map.pix")
+            print ("Transition raster: " + transition_file)
+            if os.path.exists(transition_file) == True and delete_if_exist == True:
+                os.remove(transition_file)
+            with ds.open_dataset(read_file, ds.eAM_READ) as ds3:
+                create_raster_file(transition_file, ds3.width, ds3.height, 1, gobs.DT_32S,
+                                   ds3.crs, ds3.geocoding)
+
+        try:
+            full_matrices, pixel_counts, transitions = parallel_confusion(read_file, read_channels, block_lines,
+                                                                          workers, window=read_window,
+                                                                          nodata_value=nodata_value,
+                                                                          apply_nodata_mask=apply_common_nodata,
+                                                                          spans=subset_spans,
+                                                                          transition_table=write_transition_table,
+                                                                          transition_file=transition_file,
+                                                                          transition_factor=transition_factor,
+                                                                          sparse=sparse_classes)
+        except DenseMatrixError as e:
+            # Float, negative or high cardinality layers cannot be counted in a dense matrix
+            print ("Error - " + str(e))
+            print ("Use sparse_classes = 'yes' or block_processing = 'no' for these thematic layers")
+            sys.exit()
+        except ValueError as e:
+            # Transition codes out of range (see transition_factor)
+            print ("Error - " + str(e))
+            sys.exit()
+        num_pixels = int(pixel_counts[0])
+        layer_nodata = [int(count) for count in pixel_counts[1:]]
+
+    else:
+        with ds.open_dataset(read_file) as ds5:
+            reader = ds.BasicReader(ds5, read_channels)
+            # read the raster channels
+            if read_window is None:
+                read_window = (0, 0, reader.width, reader.height)
+            raster = reader.read_raster(*read_window)
+
+            layer_1 = raster.data[:, :, (0)].reshape(-1)
+            layer_2 = raster.data[:, :, (1)].reshape(-1)
+
+        # Only the pixels inside the subset polygons are compared
+        if subset_spans is not None:
+            inside = spans_to_mask(subset_spans, read_window).reshape(-1)
+            layer_1 = layer_1[inside]
+            layer_2 = layer_2[inside]
+
+        num_pixels = layer_1.size
+        layer_nodata = [int(np.count_nonzero(layer_1 == nodata_value)),
+                        int(np.count_nonzero(layer_2 == nodata_value))]
+
+    if num_pixels == 0:
+        # The subset polygons are too small to hold a pixel centre
+        print ("Error - The subset polygons do not cover any pixel of the input_file")
+        sys.exit()
 
+    for layer_num, nodata_count in enumerate(layer_nodata, start=1):
+        nval_pct = round((nodata_count / num_pixels) * 100,2)
+        print ("Number of NoData values in layer " + str(layer_num) + " : " + str(nodata_count) + " (" + str (nval_pct) + "%)")
 
-print("\t")
-output_file_lines.append(new_line)
-output_line = ((time.strftime("%H:%M:%S")) + " Comparing the two thematic layers")
-print(output_line)
-output_file_lines.append(output_line)
 
-# CM - write the first two lines of the confusion matrix
-output_cmatrix_lines = []
-output_cmatrix_lines.append(new_line)
-out_cm1 = (".;.;layer2;.;.;.;.;.;.;layer2")
-output_cmatrix_lines.append(out_cm1)
-out_cm2a = ("..."+";"+"cl"+";")
-out_cm2b = ';'.join(map(str,unique_2))
-out_cm2 = (out_cm2a + out_cm2b + ";.;cl;"+ out_cm2b)
-print (out_cm2)
-output_cmatrix_lines.append(out_cm2)
+    # --------------------------------------------------------------------------------------------------------------------
+    # C)  Find the unique values
+    # --------------------------------------------------------------------------------------------------------------------
 
+    new_line = ("\t")
+    output_folder = os.path.dirname(input_file)
+    output_file_lines = []
 
-for ii in unique_1:
-    print("-------------------------------------------------------------")
-    output_line = ("Thematic layer 1 unique value: " + str (ii))
+    # A ) Open input file
+    print("\t")
+    output_line = ((time.strftime("%H:%M:%S")) + " Reading the input raster file")
     print (output_line)
     output_file_lines.append(output_line)
 
-    layer_1_rsp = layer_1.reshape(-1)
-    layer_2_rsp = layer_2.reshape(-1)
-
-    layer_2_rsp = np.delete (layer_2_rsp, np.where(layer_1_rsp != ii))
-    unique_tp, frequency_tp = np.unique(layer_2_rsp, return_counts=True)
-
-    output_line = (" Unique value(s) of thematic layer 2: " + str (unique_tp))
-    print (output_line)
-    output_file_lines.append(output_line)
-    output_line = (" Frequency of unique values: " + str (frequency_tp))
-    print(output_line)
-    output_file_lines.append(output_line)
-    output_file_lines.append(new_line)
+    with ds.open_dataset(input_file, ds.eAM_READ) as ds2:
+        aux = ds2.aux_data
+        num_cols = ds2.width
+        num_rows = ds2.height
+        num_channels = ds2.chan_count
+        ref_crs = ds2.crs  # coordinate system
+        ref_geocoding = ds2.geocoding  # Geocoding
+
+        output_line = ("Input raster: " + input_file)
+        print (output_line)
+        output_file_lines.append(output_line)
+
+        output_line =("  X - Number of columns (pixels): " + str(num_cols))
+        print (output_line)
+        output_file_lines.append(output_line)
+
+        output_line = ("  Y - Number of rows (lines): " + str(num_rows))
+        print (output_line)
+        output_file_lines.append(output_line)
+
+        output_line = ("Number of channels: " + str(num_channels))
+        print (output_line)
+
+        print (new_line)
+        output_file_lines.append(new_line)
+
+
+    # With block processing, the frequency matrices of all the pairs of layers come from the
+    # single raster pass. The full read only compares the two layers.
+    if block_processing is False:
+        if apply_common_nodata is True:
+            # Joint NoData mask: pixels where either layer is NoData are removed from both layers
+            valid = nodata_mask(layer_1, layer_2, nodata_value)
+            layer_1 = layer_1[valid]
+            layer_2 = layer_2[valid]
+            print("Size of layer 1 after NoData removal: " + str(len(layer_1)))
+            print("Size of layer 2 after NoData removal: " + str(len(layer_2)))
+
+        # Single pass frequency matrix. The unique values and frequencies of each layer
+        # are the row and column totals of the matrix.
+        if sparse_classes is True:
+            full_matrices = [count_rows(np.column_stack((layer_1, layer_2)))]
+        else:
+            full_matrix, unique_1, unique_2 = confusion_matrix(layer_1, layer_2)
+            full_matrices = [full_matrix]
+            full_classes = (unique_1, unique_2)
+        if write_transition_table is True:
+            transitions = count_rows(np.column_stack((layer_1, layer_2)))
+
+    header_lines = output_file_lines
+    pairs = layer_pairs(len(classif_layers))
+    for pair_index, (layer_a, layer_b) in enumerate(pairs):
+        output_file_lines = list(header_lines)
+        name_a = "classif_layer_" + str(layer_a + 1)
+        name_b = "classif_layer_" + str(layer_b + 1)
+
+        if len(pairs) == 1:
+            file = os.path.join(output_folder, output_file_name)
+        else:
+            pair_file_name = (output_file_name[:-4] + "_ch" + str(classif_layers[layer_a]) + "_ch"
+                              + str(classif_layers[layer_b]) + ".txt")
+            file = os.path.join(output_folder, pair_file_name)
+
+        if sparse_classes is True:
+            # Long-format table of the pairs of classes found, no matrix
+            print("\t")
+            output_line = ((time.strftime("%H:%M:%S")) + " Writing the table of the pairs of classes")
+            print (output_line)
+            pair_keys, pair_counts = full_matrices[pair_index]
+            print (" Number of classes (" + name_a + "): " + str(np.unique(pair_keys[:, 0]).size))
+            print (" Number of classes (" + name_b + "): " + str(np.unique(pair_keys[:, 1]).size))
+            print (" Number of pairs of classes: " + str(len(pair_counts)))
+            print (" Pixels count: " + str(pair_counts.sum()))
+            with open(file, "w") as f:
+                f.write("\n".join(pair_table_lines(full_matrices[pair_index])))
+            print (file)
+            columns = [("layer1", pair_keys[:, 0]), ("layer2", pair_keys[:, 1]), ("count", pair_counts)]
+            for written in write_table(file[:-4], columns, table_formats):
+                print (written)
+            continue
+
+        #B) Find the uniques values for both input layer
+        print("\t")
+        output_line = ((time.strftime("%H:%M:%S")) + " Finding the uniques values for both thematic rasters")
+        print (output_line)
+        output_file_lines.append(output_line)
+
+        if block_processing is True:
+            cmatrix, unique_1, unique_2 = compact_matrix(full_matrices[pair_index])
+        else:
+            cmatrix = full_matrices[pair_index]
+            unique_1, unique_2 = full_classes
+
+        frequency_1 = cmatrix.sum(axis=1)
+        frequency_2 = cmatrix.sum(axis=0)
+
+
+        # print unique values array
+        tempuniq = str(unique_1)
+        output_line = (" Unique Values (" + name_a + ") :" + tempuniq)
+        print (output_line)
+        output_file_lines.append(output_line)
+        tempuniq = str(unique_2)
+        output_line = (" Unique Values (" + name_b + ") :" + tempuniq)
+        print (output_line)
+        output_file_lines.append(output_line)
+
+        # print frequency array
+        tempfreq = str(frequency_1)
+        output_line = (" Frequency Values (" + name_a + "): " + tempfreq)
+        print (output_line)
+        output_file_lines.append(output_line)
+        tempfreq = str(frequency_2)
+        output_line = (" Frequency Values (" + name_b + "): "+ tempfreq)
+        print (output_line)
+        output_file_lines.append(output_line)
+
+        # Verification to check if there is the same number of pixels in both frequency
+        sum_layer_1 = np.sum(frequency_1)
+        sum_layer_2 = np.sum(frequency_2)
+
+        if sum_layer_1 != sum_layer_2 :
+            print (" Error - the sum of pixels for both layer is not the same")
+            sys.exit()
+        else :
+            output_line = (" Pixels count for layer " + str(layer_a + 1) + ": " + str(sum_layer_1))
+            output_file_lines.append(output_line)
+            print (output_line)
+            output_line = (" Pixels count for layer " + str(layer_b + 1) + ": " + str(sum_layer_2))
+            output_file_lines.append(output_line)
+            print (output_line)
+
+
+        print("\t")
+        output_file_lines.append(new_line)
+        output_line = ((time.strftime("%H:%M:%S")) + " Comparing the two thematic layers")
+        print(output_line)
+        output_file_lines.append(output_line)
+
+        # Per class report and confusion matrix lines, both derived from the frequency matrix
+        output_file_lines.extend(class_detail_lines(cmatrix, unique_1, unique_2))
+        output_cmatrix_lines = confusion_matrix_lines(cmatrix, unique_1, unique_2)
+        for output_line in output_cmatrix_lines:
+            print (output_line)
+
+
+        with open(file, "w") as f:
+            f.write("\n".join(output_file_lines))
+
+        with open(file, "a") as f:
+            f.write("\n".join(output_cmatrix_lines))
+
+        for written in write_matrix(file[:-4], cmatrix, unique_1, unique_2, table_formats):
+            print (written)
+
+        if write_agreement_metrics is True:
+            print("\t")
+            output_line = ((time.strftime("%H:%M:%S")) + " Computing the agreement metrics")
+            print(output_line)
+            metrics_lines = agreement_metrics_lines(cmatrix, unique_1, unique_2, bootstrap_samples,
+                                                    bootstrap_confidence)
+            for output_line in metrics_lines:
+                print (output_line)
+            with open(file[:-4] + "_metrics.txt", "w") as f:
+                f.write("\n".join(metrics_lines))
+
+    if write_transition_table is True:
+        print("\t")
+        output_line = ((time.strftime("%H:%M:%S")) + " Writing the transition table")
+        print(output_line)
+        labels = ["ch" + str(channel) for channel in classif_layers]
+        file = os.path.join(output_folder, output_file_name[:-4] + "_transitions.txt")
+        with open(file, "w") as f:
+            f.write("\n".join(transition_table_lines(transitions, labels)))
+        print(file)
+        transition_keys, transition_counts = transitions
+        columns = [(label, transition_keys[:, ii]) for ii, label in enumerate(labels)]
+        columns.append(("count", transition_counts))
+        for written in write_table(file[:-4], columns, table_formats):
+            print (written)
 
-    # ------------------------------------------------------------------------------------
     print ("\t")
-    # Need to find occurences where an unique value in layer does not contain all original
-    # unique values of the second layer and add a frequency of 0.
-
-    matrix_output_value = []
-    matrix_output_freq = []
-
-    print (unique_2)
-    print (list(unique_2))
-    unique_tp_list = list(unique_tp)
-    frequency_tp_list = list(frequency_tp)
-
-    for jj in unique_2:
-        print ("val" + str(jj))
-
-        if jj in unique_tp:
-            matrix_output_value.append(jj)
-            pos_val = unique_tp_list.index(jj)
-            fq = frequency_tp_list[pos_val]
-            matrix_output_freq.append(fq)
-        else:
-            matrix_output_value.append (jj)
-            matrix_output_freq.append(0)
-
-    print (ii, matrix_output_value, matrix_output_freq)
-
-    # CM - write the other lines of the confusion matrix
-    out_cm3a = ("layer1" + ";"+ str(ii)+";")
-    out_cm3b = ';'.join(map(str, matrix_output_freq))
-    out_cm3c = (out_cm3a + out_cm3b + ";.;" + str(ii)+";")
-
-    #compute the frequency in pct
-    temp_sum = np.sum(matrix_output_freq)
-    temp_pct = []
-    for ii in list(matrix_output_freq):
-        aa = round((ii/temp_sum) * 100,2)
-        temp_pct.append (aa)
-
-    out_cm3d = ';'.join(map(str, temp_pct))
-    out_cm3 = out_cm3c + out_cm3d
-    print (out_cm3)
-    output_cmatrix_lines.append(out_cm3)
-
-
-with open(file, "w") as f:
-    f.write("\n".join(output_file_lines))
-
-with open(file, "a") as f:
-    f.write("\n".join(output_cmatrix_lines))
-
-print ("\t")
-print("--------------------------------------------------------------------------------------------------------------")
-print ("\t")
-print((time.strftime("%H:%M:%S")))
-print("All processing completed")
-print("\t")
-end = time.time()
-
-ellapse_time_seconds = round((end - start), 2)
-ellapse_time_minutes = round((ellapse_time_seconds / 60), 2)
-ellapse_time_hours = round((ellapse_time_seconds / 3600), 2)
-
-print("Processing time (seconds): " + str(ellapse_time_seconds))
-print("Processing time (minutes): " + str(ellapse_time_minutes))
-print("Processing time (hours): " + str(ellapse_time_hours))
+    print("--------------------------------------------------------------------------------------------------------------")
+    print ("\t")
+    print((time.strftime("%H:%M:%S")))
+    print("All processing completed")
+    print("\t")
+    end = time.time()
+
+    ellapse_time_seconds = round((end - start), 2)
+    ellapse_time_minutes = round((ellapse_time_seconds / 60), 2)
+    ellapse_time_hours = round((ellapse_time_seconds / 3600), 2)
+
+    print("Processing time (seconds): " + str(ellapse_time_seconds))
+    print("Processing time (minutes): " + str(ellapse_time_minutes))
+    print("Processing time (hours): " + str(ellapse_time_hours))
 
@@ -15,6 +15,7 @@ locale.setlocale(locale.LC_NUMERIC, "C")
 import os, glob, fnmatch, sys, time
 
 from pci.api import datasource as ds
+from pci.api import gobs
 from pci.clip import clip
 from pci.thr import thr
 from pci.model import model
@@ -22,6 +23,16 @@ from pci.exceptions import *
 from pci.exceptions import PCIException
 import numpy as np
 
+from raster_block_io import create_raster_file, geocoding_transform
+from site_labelling_tools import label_connected_sites
+from table_output_tools import table_format_list, write_table
+from vector_mask_tools import spans_to_mask, subset_mask_spans
+from zonal_stats_tools import parallel_zonal_histogram, site_histogram_lines, site_slices
+from zonal_stats_tools import class_histograms, site_statistics_columns, site_statistics_lines
+from zonal_stats_tools import value_moments, zonal_value_statistics
+from zonal_stats_tools import site_majority, site_majority_lines, write_site_raster
+from zonal_stats_tools import site_extents, site_geometry, site_geometry_lines
+
 
 start = time.time()
 # -----------------------------------------------------------------------------------------------------
@@ -37,6 +48,11 @@ Requirements:
     1) The two thematic classifications must be stored in the same pix file. 
     2) The two thematic classifications must be in 8 bit. 
     3) If remove_nodata = True , only the common area will be process
+The class histogram of every site is counted in one pass (see zonal_stats_tools.py), not with
+one scan of the pixels per site. The continuous layers of value_channels are summarized per site
+(count, mean, min, max, std and optionally the median) in the same read. The site IDs can also be
+derived from a binary or class raster by connected component labelling (label_sites, see
+site_labelling_tools.py).
 
 '''
 # ----------------------------------------------------------------------------------------------
@@ -47,6 +63,65 @@ Requirements:
 input_file = r'D:\HBL_3MAPS_regression_rates\2010_2024_classif_comparison.pix'
 site_id_ref_1 = 4
 classif_layer_2 = 5
+# Additional classification layers (e.g. [6, 7] for the other years) counted against the site IDs
+# in the same read. The counts of every layer are written next to results_1.txt, as
+# results_1_ch<channel>.txt, with the same line format.
+additional_class_layers = []
+# Trajectories - available options are 'yes' or 'no'
+# The classes of classif_layer_2 and additional_class_layers of every pixel are combined into one
+# trajectory code (e.g. 3, 1, 2 -> 30102 with trajectory_factor = 100) counted for every site and
+# written to results_1_trajectories.txt. trajectory_factor must be greater than all the classes, and
+# trajectory_factor ** (number of class layers) must fit in a 64 bit signed integer.
+write_trajectories = 'no'
+trajectory_factor = 100
+
+# Site ID labelling - available options are 'yes' or 'no'
+# With label_sites = 'yes', the site IDs are not read from site_id_ref_1: they are derived from
+# label_source_channel (binary or class raster) by connected component labelling, and written to
+# <output_file_name>_site_id.pix (32 bit signed, 0 = no site). The raster is labelled tile by tile
+# (block_lines x label_block_pixels) and the labels are merged across the tile seams.
+label_sites = 'no'
+label_source_channel = 5
+# Values of label_source_channel forming the sites ([] = every value but nodata_value)
+label_classes = []
+# With label_by_class = 'yes', neighbouring pixels of different values are different sites
+label_by_class = 'yes'
+# 4 or 8 connectivity
+label_connectivity = 8
+label_block_pixels = 4096
+# Continuous layers (e.g. area-loss rates) summarized per site in the same read, e.g. [6, 7].
+# The count, mean, min, max and std of every channel are written to
+# <output_file_name>_site_statistics.txt. NaN and value_nodata values are not used.
+value_channels = []
+value_nodata = None
+# The exact median of every channel is added with value_median = 'yes'. It keeps all the valid
+# values in memory (sorted once at the end), the other statistics only one row per site.
+# Available options are 'yes' or 'no'
+value_median = 'no'
+
+# Majority class of every site (most frequent class of classif_layer_2, purity = fraction of the
+# site in that class, number of classes) written to <output_file_name>_site_majority.txt.
+# Available options are 'yes' or 'no'
+write_site_majority = 'no'
+# The majority class, purity and number of classes are also painted back to a 3 channels 32 bit
+# real raster aligned with the input, <output_file_name>_site_majority.pix (0 outside the sites).
+# Available options are 'yes' or 'no'
+majority_raster = 'no'
+
+# Location of every site written to <output_file_name>_site_extents.txt: pixel count, pixel
+# bounding box (pixel_min, line_min, pixel_max, line_max of input_file, inclusive), centroid in
+# pixel/line and map coordinates, and area in map units. Available options are 'yes' or 'no'
+write_site_extents = 'no'
+
+# Columnar outputs of the site tables (results_1, the additional class layers, the trajectories,
+# the site majority and the site statistics), written from the numpy arrays next to the text files:
+# 'npz' (results_1.npz, read with np.load), 'npy' (results_1_npy folder with one .npy file per
+# column, that can be memory-mapped with np.load(..., mmap_mode="r")) and 'csv' (results_1.csv).
+# e.g. table_formats = ['npz', 'csv']
+table_formats = []
+# The semicolon text tables can be skipped when columnar outputs are written.
+# Available options are 'yes' or 'no'
+write_text_tables = 'yes'
 
 # available options are 'yes' or 'no'
 remove_nodata = 'yes'
@@ -56,395 +131,699 @@ nodata_value = 0
 subset_data = 'no'
 subset_vector_file = r"D:\HBL_Palsas_classif\clip_layer_test2.pix"
 subset_segment = 2
+# With direct_read = 'yes', the subset polygons are rasterized in memory and only the pixels
+# inside the polygons are processed. The rasterized polygons can be cached (in the folder
+# subset_mask_cache_folder) and reused by the next runs with the same subset vector file and
+# raster geocoding. The cache files are not deleted. Available options are 'yes' or 'no'
+subset_mask_cache = 'no'
+# None = a subset_mask_cache folder next to input_file
+subset_mask_cache_folder = None
 
 output_file_name = "Palsa_classif_compare_full.txt"
 
+# Direct read - available options are 'yes' or 'no'
+# The two layers are read directly from input_file, over the pixel window of the subset
+# vector extents (or the whole image), instead of being clipped to an intermediate
+# <prefix>_<base>.pix file. The subset vector file must then be in the coordinate system of
+# input_file (it is not reprojected, unlike with CLIP).
+direct_read = 'yes'
+
+# Block processing - available options are 'yes' or 'no'
+# The two layers are read window by window (block_lines lines at a time) and the (site, class)
+# counts of every block are merged into a running table. The memory use is bounded by the block
+# size and the number of (site, class) pairs, not by the image size.
+block_processing = 'yes'
+block_lines = 1024
+# Number of worker processes for block processing. The image is split into row bands that are
+# read and counted in parallel; the partial tables are merged at the end. 1 = no worker pool.
+workers = 1
+# Tile cache for the re-runs - available options are 'yes' or 'no'
+# The partial tables of every block are stored in the folder zonal_tile_cache\<output_file_name>
+# (next to input_file), keyed by a hash of the block pixels and the settings. At the next run,
+# only the blocks whose pixels changed are counted again. The tiles are cut on the multiples of
+# block_lines, whatever the number of workers; the tile files not used by the run (e.g. after a
+# change of block_lines or of the subset window) are deleted. Requires block_processing = 'yes'.
+tile_cache = 'no'
+
 delete_if_exist = True
 # ---------------------------------------------------------------------------------------------
 #  Main program
 # ----------------------------------------------------------------------------------------------
 #
-yes_validation_list = ["yes", "y", "yse", "ys"]
-
-
-# A ) Conformity  check
-if remove_nodata.lower() in yes_validation_list:
-    remove_nodata = True
-else:
-    remove_nodata = False
-
-if subset_data.lower() in yes_validation_list:
-    subset_data = True
-    if not os.path.exists(subset_vector_file):
-        print ("Error - The subset_vector_file does not exists or the path is wrong")
+# The main program is guarded because the worker processes (workers > 1) import this script.
+if __name__ == "__main__":
+    yes_validation_list = ["yes", "y", "yse", "ys"]
+
+
+    # A ) Conformity  check
+    if remove_nodata.lower() in yes_validation_list:
+        remove_nodata = True
+    else:
+        remove_nodata = False
+
+    if subset_data.lower() in yes_validation_list:
+        subset_data = True
+        if not os.path.exists(subset_vector_file):
+            print ("Error - The subset_vector_file does not exists or the path is wrong")
+            sys.exit()
+    else:
+        subset_data = False
+
+    if subset_mask_cache.lower() in yes_validation_list:
+        subset_mask_cache = True
+    else:
+        subset_mask_cache = False
+
+    if direct_read.lower() in yes_validation_list:
+        direct_read = True
+    else:
+        direct_read = False
+
+    if block_processing.lower() in yes_validation_list:
+        block_processing = True
+        if int(block_lines) != block_lines or block_lines < 1:
+            print ("Error - block_lines must be an integer >= 1")
+            sys.exit()
+    else:
+        block_processing = False
+
+    if label_sites.lower() in yes_validation_list:
+        label_sites = True
+        if label_connectivity not in (4, 8):
+            print ("Error - label_connectivity must be 4 or 8")
+            sys.exit()
+        site_channel = label_source_channel
+    else:
+        label_sites = False
+        site_channel = site_id_ref_1
+
+    if label_by_class.lower() in yes_validation_list:
+        label_by_class = True
+    else:
+        label_by_class = False
+
+    class_layers = [classif_layer_2] + list(additional_class_layers)
+    if write_trajectories.lower() in yes_validation_list:
+        write_trajectories = True
+        if int(trajectory_factor) != trajectory_factor or trajectory_factor < 2:
+            print ("Error - trajectory_factor must be an integer >= 2")
+            sys.exit()
+        if int(trajectory_factor) ** len(class_layers) > np.iinfo(np.int64).max:
+            # The trajectory codes are 64 bit signed integers
+            print ("Error - trajectory_factor ** " + str(len(class_layers)) + " (number of class layers) "
+                   + "does not fit in 64 bit signed integers")
+            sys.exit()
+        trajectory_codes_factor = trajectory_factor
+    else:
+        write_trajectories = False
+        trajectory_codes_factor = None
+
+    if value_median.lower() in yes_validation_list:
+        value_median = True
+    else:
+        value_median = False
+
+    if write_site_majority.lower() in yes_validation_list:
+        write_site_majority = True
+    else:
+        write_site_majority = False
+
+    if majority_raster.lower() in yes_validation_list:
+        majority_raster = True
+    else:
+        majority_raster = False
+
+    if write_site_extents.lower() in yes_validation_list:
+        write_site_extents = True
+    else:
+        write_site_extents = False
+
+    for table_format in table_formats:
+        if table_format not in table_format_list:
+            print ("Error - table_formats must be in " + str(table_format_list))
+            sys.exit()
+
+    if write_text_tables.lower() in yes_validation_list:
+        write_text_tables = True
+    elif not table_formats:
+        print ("Error - write_text_tables = 'no' requires at least one table format in table_formats")
+        sys.exit()
+    else:
+        write_text_tables = False
+
+    if tile_cache.lower() in yes_validation_list:
+        tile_cache = True
+        if block_processing is False:
+            print ("Error - tile_cache requires block_processing = 'yes'")
+            sys.exit()
+    else:
+        tile_cache = False
+
+    if int(workers) != workers or workers < 1:
+        print ("Error - workers must be an integer >= 1")
+        sys.exit()
+    elif workers > 1 and block_processing is False:
+        print ("Error - workers > 1 requires block_processing = 'yes'")
         sys.exit()
-else:
-    subset_data = False
-
-# --------------------------------------------------------------------------------------------------------------------
-#B)  Data preprocessing
-# --------------------------------------------------------------------------------------------------------------------
-print("\t")
-output_line = ((time.strftime("%H:%M:%S")) + " Data preprocessing")
-print (output_line)
-output_line = ((time.strftime("%H:%M:%S")) + " Extracting the thematic layers form the main database (data_copy)")
-print (output_line)
-
-base = os.path.basename(input_file)
-prefix = (output_file_name[:-4] + "_")
-output_folder = os.path.dirname(input_file)
-clip_out = os.path.join(output_folder, prefix + base)
-
-fili = input_file
-print (fili)
-dbic = [site_id_ref_1, classif_layer_2]
-dbsl = []
-sltype = ""
-filo = clip_out
-print (filo)
-ftype = "PIX"
-foptions = ""
-
-if subset_data is True:
-    print ("here_1")
-    clipmeth = "LAYERVEC"
-    clipfil = subset_vector_file
-    cliplay = [subset_segment]
-    laybnds = "SHAPES"
-else:
-    print ("here_2")
-    clipmeth = "FILE"
-    clipfil = input_file
-    cliplay = [1]
-    laybnds = "EXTENTS"
-
-coordtyp = ""
-clipul = ""
-cliplr = ""
-clipwh = ""
-initvalu = [0]
-setnodat = "Y"
-oclipbdy = "N"
-
-# check if filo exists
-if os.path.exists(filo) == True and delete_if_exist == True:
-    os.remove(filo)
-
-try:
-    clip(fili, dbic, dbsl, sltype, filo, ftype,
-         foptions, clipmeth, clipfil, cliplay,
-         laybnds, coordtyp, clipul, cliplr,
-         clipwh, initvalu, setnodat, oclipbdy)
-except PCIException as e:
-    print(e)
-except Exception as e:
-    print(e)
-
-input_file = filo
-
-# -----------------------------------------------------------------------------------------------------------------------
-# Quick check for the presence of NoData values for the site ID cha:
-
-if remove_nodata is True:
-
-    print ()
-    with ds.open_dataset(filo) as ds5:
-        reader = ds.BasicReader(ds5)
-        # read the raster channels
-        raster = reader.read_raster(0, 0, reader.width, reader.height)
-
-        layer_1 = raster.data[:, :, 0]
-        layer_2 = raster.data[:, :, 1]
-
-        layer_1_rsp = layer_1.reshape(-1)
-        layer_2_rsp = layer_2.reshape(-1)
-
-        layer_1_nval = np.delete(layer_1_rsp, np.where(layer_1_rsp == nodata_value))
-
-        layer_1_nodata = len(layer_1_rsp) - len(layer_1_nval)
-        layer_1_nval_pct = round((layer_1_nodata / (reader.width * reader.height)) * 100, 2)
-
-        print ("Number of NoData values in layer 1 : " + str(layer_1_nodata) + " (" + str (layer_1_nval_pct) + "%)")
-        #print ("Number of NoData values in layer 2 : " + str(layer_2_nodata) + " (" + str (layer_2_nval_pct) + "%)")
-
-        # Delete the corresponding nodata value index from layer_1 to the second layer.
-        layer_2_nval = np.delete(layer_2_rsp, np.where(layer_1_rsp == nodata_value))
-
 
+    # --------------------------------------------------------------------------------------------------------------------
+    #B)  Data preprocessing
+    # --------------------------------------------------------------------------------------------------------------------
+    print("\t")
+    output_line = ((time.strftime("%H:%M:%S")) + " Data preprocessing")
+    print (output_line)
 
-# --------------------------------------------------------------------------------------------------------------------
-# C)  Find the unique values
-# --------------------------------------------------------------------------------------------------------------------
+    base = os.path.basename(input_file)
+    prefix = (output_file_name[:-4] + "_")
+    output_folder = os.path.dirname(input_file)
+    clip_out = os.path.join(output_folder, prefix + base)
+
+    if direct_read is True:
+        output_line = ((time.strftime("%H:%M:%S")) + " Reading the layers directly from the main database")
+        print (output_line)
+        read_file = input_file
+        read_channels = [site_channel] + class_layers
+        read_value_channels = list(value_channels)
+
+        subset_spans = None
+        with ds.open_dataset(input_file, ds.eAM_READ) as ds1:
+            read_window = (0, 0, ds1.width, ds1.height)
+            if subset_data is True:
+                # Window of the subset extents and rasterized subset polygons
+                cache_folder = None
+                if subset_mask_cache is True:
+                    cache_folder = subset_mask_cache_folder or os.path.join(output_folder, "subset_mask_cache")
+                try:
+                    read_window, subset_spans = subset_mask_spans(subset_vector_file, subset_segment,
+                                                                  geocoding_transform(ds1), ds1.width,
+                                                                  ds1.height, cache_folder, ds1.crs)
+                except ValueError as e:
+                    print ("Error - " + str(e))
+                    sys.exit()
+                if read_window is None:
+                    print ("Error - The subset vector layer does not overlap the input_file")
+                    sys.exit()
+
+        print ("Pixel window (x, y, width, height): " + str(read_window))
+
+    else:
+        output_line = ((time.strftime("%H:%M:%S")) + " Extracting the thematic layers form the main database (data_copy)")
+        print (output_line)
+
+        fili = input_file
+        print (fili)
+        dbic = [site_channel] + class_layers + list(value_channels)
+        dbsl = []
+        sltype = ""
+        filo = clip_out
+        print (filo)
+        ftype = "PIX"
+        foptions = ""
+
+        if subset_data is True:
+            print ("here_1")
+            clipmeth = "LAYERVEC"
+            clipfil = subset_vector_file
+            cliplay = [subset_segment]
+            laybnds = "SHAPES"
+        else:
+            print ("here_2")
+            clipmeth = "FILE"
+            clipfil = input_file
+            cliplay = [1]
+            laybnds = "EXTENTS"
+
+        coordtyp = ""
+        clipul = ""
+        cliplr = ""
+        clipwh = ""
+        initvalu = [0]
+        setnodat = "Y"
+        oclipbdy = "N"
+
+        # check if filo exists
+        if os.path.exists(filo) == True and delete_if_exist == True:
+            os.remove(filo)
+
+        try:
+            clip(fili, dbic, dbsl, sltype, filo, ftype,
+                 foptions, clipmeth, clipfil, cliplay,
+                 laybnds, coordtyp, clipul, cliplr,
+                 clipwh, initvalu, setnodat, oclipbdy)
+        except PCIException as e:
+            print(e)
+        except Exception as e:
+            print(e)
+
+        input_file = filo
+
+        read_file = filo
+        read_channels = list(range(1, len(class_layers) + 2))
+        read_value_channels = list(range(len(class_layers) + 2, len(class_layers) + len(value_channels) + 2))
+        read_window = None
+        subset_spans = None
+
+    # Connected component labelling of the site ID source channel. The site IDs are then read
+    # from channel 1 of site_file, where 0 is the background (NoData).
+    site_file = None
+    if label_sites is True:
+        print ("\t")
+        output_line = ((time.strftime("%H:%M:%S")) + " Labelling the sites (connected components)")
+        print (output_line)
+        site_file = os.path.join(output_folder, output_file_name[:-4] + "_site_id.pix")
+        if os.path.exists(site_file) == True and delete_if_exist == True:
+            os.remove(site_file)
+        with ds.open_dataset(read_file, ds.eAM_READ) as ds4:
+            create_raster_file(site_file, ds4.width, ds4.height, 1, gobs.DT_32S, ds4.crs, ds4.geocoding)
+        number_sites = label_connected_sites(read_file, read_channels[0], site_file, read_window, block_lines,
+                                             label_block_pixels, label_classes, nodata_value, label_by_class,
+                                             label_connectivity)
+        print ("Site ID raster: " + site_file)
+        print ("Number of sites: " + str(number_sites))
+        read_channels = [1] + read_channels[1:]
+        nodata_value = 0
+
+    # -----------------------------------------------------------------------------------------------------------------------
+    # Quick check for the presence of NoData values for the site ID cha:
 
-output_line = ((time.strftime("%H:%M:%S")) + " Creating the list of unique site ID")
-print (output_line)
+    print ()
+    if block_processing is True:
+        # Single streaming pass: the (site, class) counts of every block are merged into a running table
+        output_line = ((time.strftime("%H:%M:%S")) + " Reading the layers block by block")
+        print (output_line)
+        if workers > 1:
+            output_line = ("Number of worker processes: " + str(workers))
+            print (output_line)
+        nodata_site = nodata_value if remove_nodata is True else None
+        cache_folder = None
+        if tile_cache is True:
+            cache_folder = os.path.join(output_folder, "zonal_tile_cache", output_file_name[:-4])
+            print ("Tile cache: " + cache_folder)
+        class_tables, pixel_counts, value_stats, extents = parallel_zonal_histogram(read_file, read_channels,
+                                                                                     block_lines, workers,
+                                                                                     window=read_window,
+                                                                                     nodata_value=nodata_site,
+                                                                                     remove_nodata=remove_nodata,
+                                                                                     spans=subset_spans,
+                                                                                     value_channels=read_value_channels,
+                                                                                     value_nodata=value_nodata,
+                                                                                     site_file=site_file,
+                                                                                     trajectory_factor=trajectory_codes_factor,
+                                                                                     extents=write_site_extents,
+                                                                                     cache_folder=cache_folder,
+                                                                                     value_median=value_median)
+        if int(pixel_counts[0]) == 0:
+            # The subset polygons are too small to hold a pixel centre
+            print ("Error - The subset polygons do not cover any pixel of the input_file")
+            sys.exit()
+
+        if remove_nodata is True:
+            layer_1_nodata = int(pixel_counts[1])
+            layer_1_nval_pct = round((layer_1_nodata / int(pixel_counts[0])) * 100, 2)
+
+            print ("Number of NoData values in layer 1 : " + str(layer_1_nodata) + " (" + str (layer_1_nval_pct) + "%)")
+
+    else:
+        with ds.open_dataset(read_file) as ds5:
+            reader = ds.BasicReader(ds5, read_channels)
+            # read the raster channels
+            if read_window is None:
+                read_window = (0, 0, reader.width, reader.height)
+            raster = reader.read_raster(*read_window)
+
+            layer_1 = raster.data[:, :, 0]
+            layer_2 = raster.data[:, :, 1:]
+
+            if site_file is not None:
+                with ds.open_dataset(site_file) as ds7:
+                    site_reader = ds.BasicReader(ds7, read_channels[:1])
+                    layer_1 = site_reader.read_raster(*read_window).data[:, :, 0]
+
+            layer_1_rsp = layer_1.reshape(-1)
+            layer_2_rsp = layer_2.reshape(-1, len(class_layers))
+
+            # The value channels are read with their own reader (and data type)
+            values_rsp = np.zeros((len(layer_1_rsp), 0))
+            if read_value_channels:
+                value_reader = ds.BasicReader(ds5, read_value_channels)
+                value_raster = value_reader.read_raster(*read_window)
+                values_rsp = value_raster.data.reshape(-1, len(read_value_channels))
+
+            # Only the pixels inside the subset polygons are processed
+            if subset_spans is not None:
+                inside = spans_to_mask(subset_spans, read_window).reshape(-1)
+                layer_1_rsp = layer_1_rsp[inside]
+                layer_2_rsp = layer_2_rsp[inside]
+                values_rsp = values_rsp[inside]
+        if len(layer_1_rsp) == 0:
+            print ("Error - The subset polygons do not cover any pixel of the input_file")
+            sys.exit()
+
+        if remove_nodata is True:
+            # The pixels where the site ID is NoData are removed from both layers
+            valid = layer_1_rsp != nodata_value
+            layer_1_nval = layer_1_rsp[valid]
+            layer_2_nval = layer_2_rsp[valid]
+            values_nval = values_rsp[valid]
+
+            layer_1_nodata = len(layer_1_rsp) - len(layer_1_nval)
+            layer_1_nval_pct = round((layer_1_nodata / len(layer_1_rsp)) * 100, 2)
+
+            print ("Number of NoData values in layer 1 : " + str(layer_1_nodata) + " (" + str (layer_1_nval_pct) + "%)")
+        else:
+            layer_1_nval = layer_1_rsp
+            layer_2_nval = layer_2_rsp
+            values_nval = values_rsp
 
 
-unique_1_id, frequency_1_id = np.unique(layer_1_nval, return_counts=True)
 
-number_site_id = str (len(unique_1_id))
-print (number_site_id)
+    # --------------------------------------------------------------------------------------------------------------------
+    # C)  Find the unique values
+    # --------------------------------------------------------------------------------------------------------------------
 
-for ii, jj in zip(unique_1_id, frequency_1_id):
-    print (str(ii) + " ------ " + str(jj))
+    output_line = ((time.strftime("%H:%M:%S")) + " Creating the list of unique site ID")
+    print (output_line)
 
-# For every site ID we count the number of unique values in the second layer
-ref_layer_1_nval = layer_1_nval
-ref_layer_2_nval = layer_2_nval
+    # Class histogram of every site in one pass (see zonal_stats_tools.py). The table is sorted by
+    # site then class; the pixel count of a site is the sum of its class counts.
+    if block_processing is False:
+        class_tables = class_histograms(layer_1_nval, layer_2_nval, trajectory_codes_factor)
+        value_stats = value_moments(layer_1_nval, values_nval, value_nodata, value_median)
+        if write_site_extents is True:
+            # Pixel and line of every pixel, with the same selection as the site IDs
+            lines_rsp, pixels_rsp = np.indices(layer_1.shape)
+            pixels_rsp = pixels_rsp.reshape(-1) + read_window[0]
+            lines_rsp = lines_rsp.reshape(-1) + read_window[1]
+            if subset_spans is not None:
+                pixels_rsp = pixels_rsp[inside]
+                lines_rsp = lines_rsp[inside]
+            if remove_nodata is True:
+                pixels_rsp = pixels_rsp[valid]
+                lines_rsp = lines_rsp[valid]
+            extents = site_extents(layer_1_nval, pixels_rsp, lines_rsp)
+    sites, site_classes, site_counts = class_tables[0]
+    unique_1_id, site_starts, site_ends = site_slices(sites)
+    frequency_1_id = np.add.reduceat(site_counts, site_starts) if len(site_counts) > 0 else site_counts
+
+    number_site_id = str (len(unique_1_id))
+    print (number_site_id)
+
+    for ii, jj in zip(unique_1_id, frequency_1_id):
+        print (str(ii) + " ------ " + str(jj))
+
+    # For every site ID, the unique values of the second layer and their count
+    output_line = ((time.strftime("%H:%M:%S")) + " Counting the unique values of the second layer for every site ID")
+    print (output_line)
+    results_file = r"D:\HBL_3MAPS_regression_rates\results_1.txt"
+
+    # Same tables for the additional class layers and the trajectory codes
+    class_files = [results_file]
+    class_files.extend(results_file[:-4] + "_ch" + str(channel) + ".txt" for channel in additional_class_layers)
+    if write_trajectories is True:
+        class_files.append(results_file[:-4] + "_trajectories.txt")
+    for file, class_table in zip(class_files, class_tables):
+        if write_text_tables is True:
+            with open(file, "w") as f:
+                f.write("\n".join(site_histogram_lines(*class_table)))
+            print (file)
+        columns = [("site", class_table[0]), ("class", class_table[1]), ("count", class_table[2])]
+        for written in write_table(file[:-4], columns, table_formats):
+            print (written)
+
+    # Majority class, purity and number of classes of every site, from the class histogram table
+    if write_site_majority is True or majority_raster is True:
+        output_line = ((time.strftime("%H:%M:%S")) + " Finding the majority class of every site ID")
+        print (output_line)
+        majority = site_majority(sites, site_classes, site_counts)
+
+    if write_site_majority is True:
+        file = os.path.join(output_folder, output_file_name[:-4] + "_site_majority.txt")
+        if write_text_tables is True:
+            with open(file, "w") as f:
+                f.write("\n".join(site_majority_lines(majority)))
+            print (file)
+        columns = [(name, majority[name]) for name in ("site", "majority", "purity", "classes", "count")]
+        for written in write_table(file[:-4], columns, table_formats):
+            print (written)
+
+    if majority_raster is True:
+        # Second read of the site ID channel only: every block is painted with the site values
+        output_line = ((time.strftime("%H:%M:%S")) + " Writing the majority class raster")
+        print (output_line)
+        file = os.path.join(output_folder, output_file_name[:-4] + "_site_majority.pix")
+        if os.path.exists(file) == True and delete_if_exist == True:
+            os.remove(file)
+        with ds.open_dataset(read_file, ds.eAM_READ) as ds6:
+            create_raster_file(file, ds6.width, ds6.height, 3, gobs.DT_32R, ds6.crs, ds6.geocoding)
+        majority_values = np.column_stack((majority["majority"], majority["purity"],
+                                           majority["classes"])).astype(np.float32)
+        write_site_raster(site_file or read_file, read_channels[0], read_window, block_lines, file,
+                          majority["site"], majority_values, spans=subset_spans)
+        print (file)
+
+    # Bounding box, centroid and area of every site, in pixel and map coordinates of read_file
+    if write_site_extents is True:
+        output_line = ((time.strftime("%H:%M:%S")) + " Computing the extents of every site ID")
+        print (output_line)
+        with ds.open_dataset(read_file, ds.eAM_READ) as ds8:
+            geometry = site_geometry(extents, geocoding_transform(ds8))
+        file = os.path.join(output_folder, output_file_name[:-4] + "_site_extents.txt")
+        if write_text_tables is True:
+            with open(file, "w") as f:
+                f.write("\n".join(site_geometry_lines(geometry)))
+            print (file)
+        for written in write_table(file[:-4], list(geometry.items()), table_formats):
+            print (written)
+
+    # Per site statistics of the value channels, one line per site ID
+    if value_channels:
+        output_line = ((time.strftime("%H:%M:%S")) + " Computing the statistics of the value channels for every site ID")
+        print (output_line)
+        value_statistics = [zonal_value_statistics(moments) for moments in value_stats]
+        labels = ["ch" + str(channel) for channel in value_channels]
+        file = os.path.join(output_folder, output_file_name[:-4] + "_site_statistics.txt")
+        if write_text_tables is True:
+            with open(file, "w") as f:
+                f.write("\n".join(site_statistics_lines(unique_1_id, value_statistics, labels)))
+            print (file)
+        columns = site_statistics_columns(unique_1_id, value_statistics, labels)
+        for written in write_table(file[:-4], columns, table_formats):
+            print (written)
 
 
-string_out_list = []
-count = 1
-for site_id in unique_1_id:
-    print (" processing site " + str(count) + " of " + number_site_id)
-    #reseset the values at every loop
-    layer_1_nval = ref_layer_1_nval
-    layer_2_nval = ref_layer_2_nval
 
-    site_ID_pixels = np.delete(layer_2_nval, np.where(layer_1_nval != site_id))
-    unique_1_id, frequency_1_id = np.unique(site_ID_pixels, return_counts=True)
 
-    list_1 = unique_1_id.tolist()
-    nb_items = str(len(list_1))
-    list_2 = frequency_1_id.tolist()
-    site_id2 = str(site_id)
-    list_3 = str(list_1 + list_2)
-    list_4 = list_3.replace(",", ";")
-    list_5 = list_4.replace("[", "")
-    list_6 = list_5.replace("]", "")
-    list_7 = (site_id2 + ";" + nb_items + ";" + list_6)
-    string_out_list.append(list_7)
 
     '''
-    print("-----------------------------------------------------------------")
-
-    print (list_4)
-    print (str (site_id))
-    print (unique_1_id)
-    print (frequency_1_id)
-    print("-----------------------------------------------------------------")
-    
-    '''
-    count = count + 1
+    new_line = ("\t")
+    output_folder = os.path.dirname(input_file)
+    output_file_lines = []
+    file = os.path.join(output_folder, output_file_name)
+
+    # A ) Open input file
+    print("\t")
+    output_line = ((time.strftime("%H:%M:%S")) + " Reading the input raster file")
+    print (output_line)
+    output_file_lines.append(output_line)
 
-file = r"D:\HBL_3MAPS_regression_rates\results_1.txt"
-with open(file, "w") as f:
-    f.write("\n".join(string_out_list))
+    with ds.open_dataset(input_file, ds.eAM_READ) as ds2:
+        aux = ds2.aux_data
+        num_cols = ds2.width
+        num_rows = ds2.height
+        num_channels = ds2.chan_count
+        ref_crs = ds2.crs  # coordinate system
+        ref_geocoding = ds2.geocoding  # Geocoding
 
+        output_line = ("Input raster: " + input_file)
+        print (output_line)
+        output_file_lines.append(output_line)
 
+        output_line =("  X - Number of columns (pixels): " + str(num_cols))
+        print (output_line)
+        output_file_lines.append(output_line)
 
+        output_line = ("  Y - Number of rows (lines): " + str(num_rows))
+        print (output_line)
+        output_file_lines.append(output_line)
 
+        output_line = ("Number of channels: " + str(num_channels))
+        print (output_line)
 
-'''
-new_line = ("\t")
-output_folder = os.path.dirname(input_file)
-output_file_lines = []
-file = os.path.join(output_folder, output_file_name)
-
-# A ) Open input file
-print("\t")
-output_line = ((time.strftime("%H:%M:%S")) + " Reading the input raster file")
-print (output_line)
-output_file_lines.append(output_line)
-
-with ds.open_dataset(input_file, ds.eAM_READ) as ds2:
-    aux = ds2.aux_data
-    num_cols = ds2.width
-    num_rows = ds2.height
-    num_channels = ds2.chan_count
-    ref_crs = ds2.crs  # coordinate system
-    ref_geocoding = ds2.geocoding  # Geocoding
-
-    output_line = ("Input raster: " + input_file)
-    print (output_line)
-    output_file_lines.append(output_line)
+        print (new_line)
+        output_file_lines.append(new_line)
 
-    output_line =("  X - Number of columns (pixels): " + str(num_cols))
-    print (output_line)
-    output_file_lines.append(output_line)
 
-    output_line = ("  Y - Number of rows (lines): " + str(num_rows))
+    #B) Find the uniques values for both input layer
+    print("\t")
+    output_line = ((time.strftime("%H:%M:%S")) + " Finding the uniques values for both thematic rasters")
     print (output_line)
     output_file_lines.append(output_line)
 
-    output_line = ("Number of channels: " + str(num_channels))
-    print (output_line)
+    with ds.open_dataset(input_file) as ds3:
+        reader = ds.BasicReader(ds3)
+        # read the raster channels
+        raster = reader.read_raster(0, 0, reader.width, reader.height)
 
-    print (new_line)
-    output_file_lines.append(new_line)
+        layer_1 = raster.data[:, :, (0)]
+        layer_2 = raster.data[:, :, (1)]
 
+        if apply_common_nodata is True:
+            print ("Ataboy")
+            layer_1_rsp = layer_1.reshape(-1)
+            layer_2_rsp = layer_2.reshape(-1)
+            layer_1_nval = np.delete(layer_1_rsp, np.where(layer_1_rsp == nodata_value))
+            layer_2_nval = np.delete(layer_2_rsp, np.where(layer_1_rsp == nodata_value))
+            print("Size of layer 1 after NoData removal: " + str(len(layer_1_nval)))
+            print("Size of layer 2 after NoData removal: " + str(len(layer_2_nval)))
+            layer_1 = layer_1_nval
+            layer_2 = layer_2_nval
 
-#B) Find the uniques values for both input layer
-print("\t")
-output_line = ((time.strftime("%H:%M:%S")) + " Finding the uniques values for both thematic rasters")
-print (output_line)
-output_file_lines.append(output_line)
 
-with ds.open_dataset(input_file) as ds3:
-    reader = ds.BasicReader(ds3)
-    # read the raster channels
-    raster = reader.read_raster(0, 0, reader.width, reader.height)
+        print ("here5")
+        unique_1, frequency_1 = np.unique(layer_1, return_counts = True)
+        unique_2, frequency_2 = np.unique(layer_2, return_counts = True)
+        print ("here6")
 
-    layer_1 = raster.data[:, :, (0)]
-    layer_2 = raster.data[:, :, (1)]
 
-    if apply_common_nodata is True:
-        print ("Ataboy")
-        layer_1_rsp = layer_1.reshape(-1)
-        layer_2_rsp = layer_2.reshape(-1)
-        layer_1_nval = np.delete(layer_1_rsp, np.where(layer_1_rsp == nodata_value))
-        layer_2_nval = np.delete(layer_2_rsp, np.where(layer_1_rsp == nodata_value))
-        print("Size of layer 1 after NoData removal: " + str(len(layer_1_nval)))
-        print("Size of layer 2 after NoData removal: " + str(len(layer_2_nval)))
-        layer_1 = layer_1_nval
-        layer_2 = layer_2_nval
-
-
-    print ("here5")
-    unique_1, frequency_1 = np.unique(layer_1, return_counts = True)
-    unique_2, frequency_2 = np.unique(layer_2, return_counts = True)
-    print ("here6")
-
-
-# print unique values array
-tempuniq = str(unique_1)
-output_line = (" Unique Values (classif_layer_1) :" + tempuniq)
-print (output_line)
-output_file_lines.append(output_line)
-tempuniq = str(unique_2)
-output_line = (" Unique Values (classif_layer_2) :" + tempuniq)
-print (output_line)
-output_file_lines.append(output_line)
-
-# print frequency array
-tempfreq = str(frequency_1)
-output_line = (" Frequency Values (classif_layer_1): " + tempfreq)
-print (output_line)
-output_file_lines.append(output_line)
-tempfreq = str(frequency_2)
-output_line = (" Frequency Values (classif_layer_2): "+ tempfreq)
-print (output_line)
-output_file_lines.append(output_line)
-
-# Verification to check if there is the same number of pixels in both frequency
-sum_layer_1 = np.sum(frequency_1)
-sum_layer_2 = np.sum(frequency_2)
-
-if sum_layer_1 != sum_layer_2 :
-    print (" Error - the sum of pixels for both layer is not the same")
-    sys.exit()
-else :
-    output_line = (" Pixels count for layer 1: " + str(sum_layer_1))
-    output_file_lines.append(output_line)
+    # print unique values array
+    tempuniq = str(unique_1)
+    output_line = (" Unique Values (classif_layer_1) :" + tempuniq)
     print (output_line)
-    output_line = (" Pixels count for layer 1: " + str(sum_layer_2))
     output_file_lines.append(output_line)
-    print (output_line)
-
-
-print("\t")
-output_file_lines.append(new_line)
-output_line = ((time.strftime("%H:%M:%S")) + " Comparing the two thematic layers")
-print(output_line)
-output_file_lines.append(output_line)
-
-# CM - write the first two lines of the confusion matrix
-output_cmatrix_lines = []
-output_cmatrix_lines.append(new_line)
-out_cm1 = (".;.;layer2;.;.;.;.;.;.;layer2")
-output_cmatrix_lines.append(out_cm1)
-out_cm2a = ("..."+";"+"cl"+";")
-out_cm2b = ';'.join(map(str,unique_2))
-out_cm2 = (out_cm2a + out_cm2b + ";.;cl;"+ out_cm2b)
-print (out_cm2)
-output_cmatrix_lines.append(out_cm2)
-
-
-for ii in unique_1:
-    print("-------------------------------------------------------------")
-    output_line = ("Thematic layer 1 unique value: " + str (ii))
+    tempuniq = str(unique_2)
+    output_line = (" Unique Values (classif_layer_2) :" + tempuniq)
     print (output_line)
     output_file_lines.append(output_line)
 
-    layer_1_rsp = layer_1.reshape(-1)
-    layer_2_rsp = layer_2.reshape(-1)
-
-    layer_2_rsp = np.delete (layer_2_rsp, np.where(layer_1_rsp != ii))
-    unique_tp, frequency_tp = np.unique(layer_2_rsp, return_counts=True)
-
-    output_line = (" Unique value(s) of thematic layer 2: " + str (unique_tp))
+    # print frequency array
+    tempfreq = str(frequency_1)
+    output_line = (" Frequency Values (classif_layer_1): " + tempfreq)
     print (output_line)
     output_file_lines.append(output_line)
-    output_line = (" Frequency of unique values: " + str (frequency_tp))
-    print(output_line)
+    tempfreq = str(frequency_2)
+    output_line = (" Frequency Values (classif_layer_2): "+ tempfreq)
+    print (output_line)
     output_file_lines.append(output_line)
-    output_file_lines.append(new_line)
-
-    # ------------------------------------------------------------------------------------
-    print ("\t")
-    # Need to find occurences where an unique value in layer does not contain all original
-    # unique values of the second layer and add a frequency of 0.
-
-    matrix_output_value = []
-    matrix_output_freq = []
 
-    print (unique_2)
-    print (list(unique_2))
-    unique_tp_list = list(unique_tp)
-    frequency_tp_list = list(frequency_tp)
+    # Verification to check if there is the same number of pixels in both frequency
+    sum_layer_1 = np.sum(frequency_1)
+    sum_layer_2 = np.sum(frequency_2)
 
-    for jj in unique_2:
-        print ("val" + str(jj))
-
-        if jj in unique_tp:
-            matrix_output_value.append(jj)
-            pos_val = unique_tp_list.index(jj)
-            fq = frequency_tp_list[pos_val]
-            matrix_output_freq.append(fq)
-        else:
-            matrix_output_value.append (jj)
-            matrix_output_freq.append(0)
+    if sum_layer_1 != sum_layer_2 :
+        print (" Error - the sum of pixels for both layer is not the same")
+        sys.exit()
+    else :
+        output_line = (" Pixels count for layer 1: " + str(sum_layer_1))
+        output_file_lines.append(output_line)
+        print (output_line)
+        output_line = (" Pixels count for layer 1: " + str(sum_layer_2))
+        output_file_lines.append(output_line)
+        print (output_line)
 
-    print (ii, matrix_output_value, matrix_output_freq)
 
-    # CM - write the other lines of the confusion matrix
-    out_cm3a = ("layer1" + ";"+ str(ii)+";")
-    out_cm3b = ';'.join(map(str, matrix_output_freq))
-    out_cm3c = (out_cm3a + out_cm3b + ";.;" + str(ii)+";")
+    print("\t")
+    output_file_lines.append(new_line)
+    output_line = ((time.strftime("%H:%M:%S")) + " Comparing the two thematic layers")
+    print(output_line)
+    output_file_lines.append(output_line)
 
-    #compute the frequency in pct
-    temp_sum = np.sum(matrix_output_freq)
-    temp_pct = []
-    for ii in list(matrix_output_freq):
-        aa = round((ii/temp_sum) * 100,2)
-        temp_pct.append (aa)
+    # CM - write the first two lines of the confusion matrix
+    output_cmatrix_lines = []
+    output_cmatrix_lines.append(new_line)
+    out_cm1 = (".;.;layer2;.;.;.;.;.;.;layer2")
+    output_cmatrix_lines.append(out_cm1)
+    out_cm2a = ("..."+";"+"cl"+";")
+    out_cm2b = ';'.join(map(str,unique_2))
+    out_cm2 = (out_cm2a + out_cm2b + ";.;cl;"+ out_cm2b)
+    print (out_cm2)
+    output_cmatrix_lines.append(out_cm2)
 
-    out_cm3d = ';'.join(map(str, temp_pct))
-    out_cm3 = out_cm3c + out_cm3d
-    print (out_cm3)
-    output_cmatrix_lines.append(out_cm3)
 
+    for ii in unique_1:
+        print("-------------------------------------------------------------")
+        output_line = ("Thematic layer 1 unique value: " + str (ii))
+        print (output_line)
+        output_file_lines.append(output_line)
 
-with open(file, "w") as f:
-    f.write("\n".join(output_file_lines))
+        layer_1_rsp = layer_1.reshape(-1)
+        layer_2_rsp = layer_2.reshape(-1)
 
-with open(file, "a") as f:
-    f.write("\n".join(output_cmatrix_lines))
-'''
+        layer_2_rsp = np.delete (layer_2_rsp, np.where(layer_1_rsp != ii))
+        unique_tp, frequency_tp = np.unique(layer_2_rsp, return_counts=True)
+
+        output_line = (" Unique value(s) of thematic layer 2: " + str (unique_tp))
+        print (output_line)
+        output_file_lines.append(output_line)
+        output_line = (" Frequency of unique values: " + str (frequency_tp))
+        print(output_line)
+        output_file_lines.append(output_line)
+        output_file_lines.append(new_line)
+
+        # ------------------------------------------------------------------------------------
+        print ("\t")
+        # Need to find occurences where an unique value in layer does not contain all original
+        # unique values of the second layer and add a frequency of 0.
+
+        matrix_output_value = []
+        matrix_output_freq = []
+
+        print (unique_2)
+        print (list(unique_2))
+        unique_tp_list = list(unique_tp)
+        frequency_tp_list = list(frequency_tp)
+
+        for jj in unique_2:
+            print ("val" + str(jj))
+
+            if jj in unique_tp:
+                matrix_output_value.append(jj)
+                pos_val = unique_tp_list.index(jj)
+                fq = frequency_tp_list[pos_val]
+                matrix_output_freq.append(fq)
+            else:
+                matrix_output_value.append (jj)
+                matrix_output_freq.append(0)
+
+        print (ii, matrix_output_value, matrix_output_freq)
+
+        # CM - write the other lines of the confusion matrix
+        out_cm3a = ("layer1" + ";"+ str(ii)+";")
+        out_cm3b = ';'.join(map(str, matrix_output_freq))
+        out_cm3c = (out_cm3a + out_cm3b + ";.;" + str(ii)+";")
+
+        #compute the frequency in pct
+        temp_sum = np.sum(matrix_output_freq)
+        temp_pct = []
+        for ii in list(matrix_output_freq):
+            aa = round((ii/temp_sum) * 100,2)
+            temp_pct.append (aa)
+
+        out_cm3d = ';'.join(map(str, temp_pct))
+        out_cm3 = out_cm3c + out_cm3d
+        print (out_cm3)
+        output_cmatrix_lines.append(out_cm3)
+
+
+    with open(file, "w") as f:
+        f.write("\n".join(output_file_lines))
+
+    with open(file, "a") as f:
+        f.write("\n".join(output_cmatrix_lines))
+    '''
 
-print ("\t")
-print("--------------------------------------------------------------------------------------------------------------")
-print ("\t")
-print((time.strftime("%H:%M:%S")))
-print("All processing completed")
-print("\t")
-end = time.time()
-
-ellapse_time_seconds = round((end - start), 2)
-ellapse_time_minutes = round((ellapse_time_seconds / 60), 2)
-ellapse_time_hours = round((ellapse_time_seconds / 3600), 2)
-
-print("Processing time (seconds): " + str(ellapse_time_seconds))
-print("Processing time (minutes): " + str(ellapse_time_minutes))
-print("Processing time (hours): " + str(ellapse_time_hours))
+    print ("\t")
+    print("--------------------------------------------------------------------------------------------------------------")
+    print ("\t")
+    print((time.strftime("%H:%M:%S")))
+    print("All processing completed")
+    print("\t")
+    end = time.time()
+
+    ellapse_time_seconds = round((end - start), 2)
+    ellapse_time_minutes = round((ellapse_time_seconds / 60), 2)
+    ellapse_time_hours = round((ellapse_time_seconds / 3600), 2)
+
+    print("Processing time (seconds): " + str(ellapse_time_seconds))
+    print("Processing time (minutes): " + str(ellapse_time_minutes))
+    print("Processing time (hours): " + str(ellapse_time_hours))
 
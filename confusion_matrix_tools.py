@@ -0,0 +1,577 @@
+#!/usr/bin/env python
+'''----------------------------------------------------------------------
+ * - Copyright (c) 2023.  All rights reserved.                          -
+
+ * ----------------------------------------------------------------------
+'''
+# -----------------------------------------------------------------------------------------------------
+#  Confusion (frequency) matrix engine for the comparison of two thematic classifications.
+# -----------------------------------------------------------------------------------------------------
+'''
+Every pixel pair (layer_1, layer_2) is encoded into one combined index
+    code = row * number_of_columns + column
+and the whole frequency matrix is built with a single np.bincount over the codes.
+
+8 bit and small integer layers are indexed directly by their value. Other layers (negative,
+floating point or very large values) are first compacted with np.unique(return_inverse=True).
+Rows and columns of classes that are not present in the data are removed, so the result holds
+the same unique values as np.unique on each layer.
+
+For block processing, accumulate_confusion adds the counts of every block to a running matrix
+indexed by the class values; compact_matrix then removes the empty rows and columns.
+parallel_confusion splits the image into row bands that are read and counted by a pool of worker
+processes; the partial integer matrices are summed in band order.
+
+The common NoData area is removed in memory: a joint boolean mask (neither layer is NoData) is
+built for every block and applied before counting. The subset polygons (see vector_mask_tools.py)
+are applied the same way.
+
+More than two layers can be compared in the same pass: every pairwise matrix is accumulated and,
+optionally, the full multi-way transition table (count of every combination of classes), built
+with a sorted-key reduction (count_rows) and merged block by block.
+
+For high cardinality layers (e.g. segment IDs), the sparse mode replaces every dense matrix by
+a long-format (class_1, class_2, count) table of the pairs that are present, built with the same
+sorted-key reduction. Its memory use depends on the number of pairs found, not on the number of
+classes squared.
+
+The from-to transition raster (change map) of the first two layers, coded
+layer_1 * transition_factor + layer_2, is written block by block during the same pass.
+
+The agreement metrics (overall agreement, kappa, quantity and allocation disagreement, producer
+and user agreement) are computed from the matrix itself. Their bootstrap confidence intervals
+resample the matrix cells (multinomial draw), never the pixels.
+'''
+import contextlib
+import itertools
+import multiprocessing
+import warnings
+
+import numpy as np
+
+from raster_block_io import full_window, read_channel_blocks, row_bands, write_raster_block
+from vector_mask_tools import spans_to_mask
+
+# Largest matrix (rows x columns) built directly from the class values.
+max_direct_cells = 2 ** 24
+
+# Lock of the worker processes writing to the same transition raster (see parallel_confusion)
+_write_lock = None
+
+
+class DenseMatrixError(ValueError):
+    '''
+    The layers cannot be counted in a dense matrix indexed by the class values (float or
+    negative classes, or too many class values, see accumulate_confusion).
+    '''
+
+
+def _direct_size(layer):
+    # Returns the number of rows/columns needed to index the layer by its values,
+    # or None if the layer must be compacted with np.unique first.
+    if layer.dtype.kind not in "ui":
+        return None
+    if layer.dtype.itemsize == 1 and layer.dtype.kind == "u":
+        return 256
+    if layer.size == 0:
+        return 1
+    if layer.min() < 0:
+        return None
+    return int(layer.max()) + 1
+
+
+def confusion_matrix(layer_1, layer_2):
+    '''
+    Computes the frequency matrix of two thematic layers with a single np.bincount.
+    Returns (matrix, unique_1, unique_2) where matrix[i, j] is the number of pixels
+    with layer_1 == unique_1[i] and layer_2 == unique_2[j].
+    '''
+    layer_1 = np.asarray(layer_1).reshape(-1)
+    layer_2 = np.asarray(layer_2).reshape(-1)
+    if layer_1.size != layer_2.size:
+        raise ValueError("The two thematic layers must have the same number of pixels")
+
+    size_1 = _direct_size(layer_1)
+    size_2 = _direct_size(layer_2)
+
+    if size_1 is not None and size_2 is not None and size_1 * size_2 <= max_direct_cells:
+        classes_1 = np.arange(size_1)
+        classes_2 = np.arange(size_2)
+        index_1 = layer_1.astype(np.int64)
+        index_2 = layer_2.astype(np.int64)
+    else:
+        classes_1, index_1 = np.unique(layer_1, return_inverse=True)
+        classes_2, index_2 = np.unique(layer_2, return_inverse=True)
+        index_1 = index_1.reshape(-1).astype(np.int64)
+        index_2 = index_2.reshape(-1).astype(np.int64)
+
+    n_rows = len(classes_1)
+    n_cols = len(classes_2)
+    codes = index_1 * n_cols + index_2
+    matrix = np.bincount(codes, minlength=n_rows * n_cols).reshape(n_rows, n_cols)
+
+    matrix, unique_1, unique_2 = compact_matrix(matrix, classes_1, classes_2)
+    return matrix, unique_1.astype(layer_1.dtype), unique_2.astype(layer_2.dtype)
+
+
+def compact_matrix(matrix, classes_1=None, classes_2=None):
+    '''
+    Removes the rows and columns of classes that are not present in the data.
+    By default the matrix is indexed by the class values (matrix[value_1, value_2]).
+    Returns (matrix, unique_1, unique_2).
+    '''
+    if classes_1 is None:
+        classes_1 = np.arange(matrix.shape[0])
+    if classes_2 is None:
+        classes_2 = np.arange(matrix.shape[1])
+
+    keep_rows = matrix.sum(axis=1) > 0
+    keep_cols = matrix.sum(axis=0) > 0
+    return matrix[keep_rows][:, keep_cols], classes_1[keep_rows], classes_2[keep_cols]
+
+
+def resize_matrix(matrix, n_rows, n_cols):
+    '''
+    Returns the matrix zero padded to at least n_rows x n_cols.
+    '''
+    n_rows = max(n_rows, matrix.shape[0])
+    n_cols = max(n_cols, matrix.shape[1])
+    if (n_rows, n_cols) == matrix.shape:
+        return matrix
+    resized = np.zeros((n_rows, n_cols), dtype=matrix.dtype)
+    resized[:matrix.shape[0], :matrix.shape[1]] = matrix
+    return resized
+
+
+def nodata_mask(layer_1, layer_2, nodata_value):
+    '''
+    Joint NoData mask: True where neither layer holds the NoData value.
+    '''
+    return (np.asarray(layer_1) != nodata_value) & (np.asarray(layer_2) != nodata_value)
+
+
+def accumulate_confusion(matrix, layer_1, layer_2, mask=None):
+    '''
+    Adds the pixel pairs of one block to a running frequency matrix indexed by the class
+    values (matrix[value_1, value_2]). Start with matrix = None; the matrix grows when a
+    block holds a larger class value. Only non-negative integer layers are supported, other
+    layers (or more than max_direct_cells cells) raise a DenseMatrixError.
+    If a boolean mask is given, only the pixels where the mask is True are counted.
+    '''
+    layer_1 = np.asarray(layer_1).reshape(-1)
+    layer_2 = np.asarray(layer_2).reshape(-1)
+    if layer_1.size != layer_2.size:
+        raise ValueError("The two thematic layers must have the same number of pixels")
+    if mask is not None:
+        mask = np.asarray(mask).reshape(-1)
+        layer_1 = layer_1[mask]
+        layer_2 = layer_2[mask]
+
+    if matrix is None:
+        matrix = np.zeros((0, 0), dtype=np.int64)
+    if layer_1.size == 0:
+        return matrix
+
+    size_1 = _direct_size(layer_1)
+    size_2 = _direct_size(layer_2)
+    if size_1 is None or size_2 is None:
+        raise DenseMatrixError("Block processing requires non-negative integer thematic layers")
+
+    matrix = resize_matrix(matrix, size_1, size_2)
+    n_rows, n_cols = matrix.shape
+    if n_rows * n_cols > max_direct_cells:
+        raise DenseMatrixError("Too many class values for a dense frequency matrix (" +
+                         str(n_rows) + " x " + str(n_cols) + ")")
+
+    codes = layer_1.astype(np.int64) * n_cols + layer_2
+    matrix += np.bincount(codes, minlength=n_rows * n_cols).reshape(n_rows, n_cols)
+    return matrix
+
+
+def percentage_matrix(matrix):
+    '''
+    Row percentages of the frequency matrix, rounded to 2 decimals.
+    '''
+    row_sum = matrix.sum(axis=1, keepdims=True)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.round((matrix / row_sum) * 100, 2)
+
+
+def class_detail_lines(matrix, unique_1, unique_2):
+    '''
+    Per class report: for every class of layer 1, the classes of layer 2 found
+    at the same location and their frequency.
+    '''
+    lines = []
+    for ii, row in zip(unique_1, matrix):
+        present = row > 0
+        lines.append("Thematic layer 1 unique value: " + str(ii))
+        lines.append(" Unique value(s) of thematic layer 2: " + str(unique_2[present]))
+        lines.append(" Frequency of unique values: " + str(row[present]))
+        lines.append("\t")
+    return lines
+
+
+def confusion_matrix_lines(matrix, unique_1, unique_2):
+    '''
+    Semicolon separated confusion matrix: frequencies on the left, row percentages on the right.
+    '''
+    lines = ["\t", ".;.;layer2;.;.;.;.;.;.;layer2"]
+    header = ';'.join(map(str, unique_2))
+    lines.append("..." + ";" + "cl" + ";" + header + ";.;cl;" + header)
+
+    pct = percentage_matrix(matrix)
+    for ii, row, row_pct in zip(unique_1, matrix, pct):
+        out_cm = ("layer1" + ";" + str(ii) + ";" + ';'.join(map(str, row)) + ";.;" + str(ii) + ";")
+        out_cm = out_cm + ';'.join(map(str, row_pct))
+        lines.append(out_cm)
+    return lines
+
+
+def add_matrices(matrix_1, matrix_2):
+    '''
+    Sums two frequency matrices indexed by the class values (None is an empty matrix).
+    '''
+    if matrix_1 is None:
+        return matrix_2
+    if matrix_2 is None:
+        return matrix_1
+    n_rows = max(matrix_1.shape[0], matrix_2.shape[0])
+    n_cols = max(matrix_1.shape[1], matrix_2.shape[1])
+    return resize_matrix(matrix_1, n_rows, n_cols) + resize_matrix(matrix_2, n_rows, n_cols)
+
+
+def layer_pairs(n_layers):
+    '''
+    Index pairs (a, b), a < b, of every pairwise comparison between n_layers layers.
+    '''
+    return list(itertools.combinations(range(n_layers), 2))
+
+
+def count_rows(keys, counts=None):
+    '''
+    Sorted-key reduction: unique rows of the (n, k) array keys and their number of
+    occurrences (or the sum of counts if given). Rows are packed into one int64 key when the
+    values allow it, otherwise np.unique(axis=0) is used. The columns of non-integer keys are
+    replaced by the rank of their values before packing, so distinct values stay distinct.
+    Returns (unique_keys, unique_counts); unique_keys keep the data type of keys for non-integer
+    keys and are int64 otherwise.
+    '''
+    keys = np.asarray(keys)
+    if counts is None:
+        counts = np.ones(len(keys), dtype=np.int64)
+    if len(keys) == 0:
+        return keys.reshape(0, keys.shape[1]), np.zeros(0, dtype=np.int64)
+
+    values = None
+    if keys.dtype.kind not in "uib":
+        # Non-integer keys (e.g. 1.2 and 1.7) are counted by rank, never truncated
+        ranks = [np.unique(keys[:, column], return_inverse=True) for column in range(keys.shape[1])]
+        values = [rank[0] for rank in ranks]
+        keys = np.column_stack([rank[1].reshape(-1) for rank in ranks])
+    keys = keys.astype(np.int64)
+    key_min = keys.min(axis=0)
+    bits = [max(1, int(ii).bit_length()) for ii in (keys.max(axis=0) - key_min)]
+    if sum(bits) <= 63:
+        # Pack every row into one int64 code, sort the codes once
+        codes = np.zeros(len(keys), dtype=np.int64)
+        for column in range(keys.shape[1]):
+            codes = (codes << bits[column]) | (keys[:, column] - key_min[column])
+        unique_codes, inverse = np.unique(codes, return_inverse=True)
+        unique_keys = np.empty((len(unique_codes), keys.shape[1]), dtype=np.int64)
+        for column in range(keys.shape[1] - 1, -1, -1):
+            unique_keys[:, column] = (unique_codes & ((1 << bits[column]) - 1)) + key_min[column]
+            unique_codes = unique_codes >> bits[column]
+    else:
+        unique_keys, inverse = np.unique(keys, axis=0, return_inverse=True)
+
+    unique_counts = np.bincount(inverse.reshape(-1), weights=counts, minlength=len(unique_keys))
+    if values is not None:
+        unique_keys = np.column_stack([values[column][unique_keys[:, column]]
+                                       for column in range(unique_keys.shape[1])])
+    return unique_keys, unique_counts.astype(np.int64)
+
+
+def merge_counts(table_1, table_2):
+    '''
+    Merges two (keys, counts) tables of count_rows (None is an empty table).
+    '''
+    if table_1 is None:
+        return table_2
+    if table_2 is None:
+        return table_1
+    return count_rows(np.concatenate([table_1[0], table_2[0]]),
+                      np.concatenate([table_1[1], table_2[1]]))
+
+
+def transition_codes(layer_1, layer_2, transition_factor):
+    '''
+    From-to transition codes layer_1 * transition_factor + layer_2 (32 bit signed integers).
+    '''
+    if layer_2.size and (layer_2.min() < 0 or layer_2.max() >= transition_factor):
+        raise ValueError("layer 2 values must be between 0 and transition_factor - 1")
+    codes = layer_1.astype(np.int64) * transition_factor + layer_2
+    if codes.size and (codes.min() < np.iinfo(np.int32).min or codes.max() > np.iinfo(np.int32).max):
+        raise ValueError("transition codes do not fit in 32 bit signed integers")
+    return codes.astype(np.int32)
+
+
+def band_confusion(input_file, channels, window, block_lines, nodata_value=None, apply_nodata_mask=False,
+                   spans=None, transition_table=False, transition_file=None, transition_factor=1000,
+                   sparse=False):
+    '''
+    Frequency matrices (indexed by the class values) of every pair of channels (see layer_pairs)
+    over one window, read block by block in a single pass.
+    Returns (matrices, pixel_counts, transitions):
+        matrices: list of frequency matrices, one per pair of channels. With sparse, every
+                  matrix is a long-format (keys, counts) table of the pairs of classes found
+                  (see count_rows).
+        pixel_counts: number of pixels read, then the number of NoData pixels of each layer
+        transitions: if transition_table, the (keys, counts) table of every combination of
+                     classes of all the channels (see count_rows), otherwise None.
+    With apply_nodata_mask, the pixels where any layer is NoData are not counted.
+    With spans (see vector_mask_tools.polygon_spans), only the pixels inside the subset
+    polygons are read and counted.
+    With transition_file, the transition codes of the first two channels (see transition_codes)
+    are written to transition_file block by block; the pixels that are not counted are set to 0.
+    '''
+    pairs = layer_pairs(len(channels))
+    matrices = [None] * len(pairs)
+    pixel_counts = np.zeros(len(channels) + 1, dtype=np.int64)
+    transitions = None
+    for xoff, yoff, block in read_channel_blocks(input_file, channels, block_lines, window=window):
+        if transition_file is not None:
+            _write_transitions(transition_file, xoff, yoff, block, transition_factor, nodata_value,
+                               apply_nodata_mask, spans)
+
+        layers = block.reshape(-1, block.shape[2])
+        if spans is not None:
+            inside = spans_to_mask(spans, (xoff, yoff, block.shape[1], block.shape[0]))
+            layers = layers[inside.reshape(-1)]
+        pixel_counts[0] += len(layers)
+        if nodata_value is not None:
+            nodata = layers == nodata_value
+            pixel_counts[1:] += np.count_nonzero(nodata, axis=0)
+            if apply_nodata_mask is True:
+                layers = layers[~nodata.any(axis=1)]
+        for ii, (aa, bb) in enumerate(pairs):
+            if sparse is True:
+                matrices[ii] = merge_counts(matrices[ii], count_rows(layers[:, [aa, bb]]))
+            else:
+                matrices[ii] = accumulate_confusion(matrices[ii], layers[:, aa], layers[:, bb])
+        if transition_table is True:
+            transitions = merge_counts(transitions, count_rows(layers))
+    return matrices, pixel_counts, transitions
+
+
+def _write_transitions(transition_file, xoff, yoff, block, transition_factor, nodata_value,
+                       apply_nodata_mask, spans):
+    # Transition codes of the counted pixels of one block, the other pixels are set to 0 (NoData
+    # or pixels outside the subset polygons may hold classes >= transition_factor)
+    counted = np.ones(block.shape[:2], dtype=bool)
+    if spans is not None:
+        counted &= spans_to_mask(spans, (xoff, yoff, block.shape[1], block.shape[0]))
+    if nodata_value is not None and apply_nodata_mask is True:
+        counted &= ~(block == nodata_value).any(axis=2)
+    codes = np.zeros(block.shape[:2], dtype=np.int32)
+    codes[counted] = transition_codes(block[:, :, 0][counted], block[:, :, 1][counted], transition_factor)
+
+    lock = _write_lock if _write_lock is not None else contextlib.nullcontext()
+    with lock:
+        write_raster_block(transition_file, xoff, yoff, codes[:, :, None])
+
+
+def _init_worker(write_lock):
+    global _write_lock
+    _write_lock = write_lock
+
+
+def _band_confusion_worker(args):
+    return band_confusion(*args)
+
+
+def parallel_confusion(input_file, channels, block_lines, workers, window=None, nodata_value=None,
+                       apply_nodata_mask=False, spans=None, transition_table=False, transition_file=None,
+                       transition_factor=1000, sparse=False, bands_per_worker=4):
+    '''
+    Frequency matrices of every pair of channels over window = (x, y, width, height) (default:
+    the whole image) computed by a pool of worker processes. Every worker opens input_file and
+    reads its own row band; only the small partial results are sent back. The partial results
+    are summed in band order, so they do not depend on the number of workers. With workers = 1
+    the bands are processed in the current process.
+    transition_file must already exist (see raster_block_io.create_raster_file); the workers
+    write their blocks to it one at a time.
+    Returns (matrices, pixel_counts, transitions), see band_confusion.
+    '''
+    if window is None:
+        window = full_window(input_file)
+    xoff, yoff, width, height = window
+    bands = row_bands(width, height, int(workers) * bands_per_worker, xoff, yoff)
+    tasks = [(input_file, channels, band, block_lines, nodata_value, apply_nodata_mask, spans,
+              transition_table, transition_file, transition_factor, sparse) for band in bands]
+
+    if int(workers) <= 1:
+        partial_results = [_band_confusion_worker(task) for task in tasks]
+    else:
+        with multiprocessing.Pool(int(workers), initializer=_init_worker,
+                                  initargs=(multiprocessing.Lock(),)) as pool:
+            partial_results = pool.map(_band_confusion_worker, tasks, chunksize=1)
+
+    matrices = [None] * len(layer_pairs(len(channels)))
+    pixel_counts = np.zeros(len(channels) + 1, dtype=np.int64)
+    transitions = None
+    merge = merge_counts if sparse is True else add_matrices
+    for partial_matrices, partial_counts, partial_transitions in partial_results:
+        matrices = [merge(matrix, partial) for matrix, partial in zip(matrices, partial_matrices)]
+        pixel_counts += partial_counts
+        transitions = merge_counts(transitions, partial_transitions)
+
+    if sparse is True:
+        empty = (np.zeros((0, 2), dtype=np.int64), np.zeros(0, dtype=np.int64))
+    else:
+        empty = np.zeros((0, 0), dtype=np.int64)
+    matrices = [empty if matrix is None else matrix for matrix in matrices]
+    if transition_table is True and transitions is None:
+        transitions = (np.zeros((0, len(channels)), dtype=np.int64), np.zeros(0, dtype=np.int64))
+    return matrices, pixel_counts, transitions
+
+
+def transition_table_lines(transitions, labels):
+    '''
+    Semicolon separated multi-way transition table: one line per combination of classes,
+    with its pixel count and percentage of the total.
+    '''
+    keys, counts = transitions
+    total = counts.sum()
+    lines = [';'.join(labels) + ";count;pct"]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        pct = np.round((counts / total) * 100, 4)
+    for key, count, count_pct in zip(keys, counts, pct):
+        lines.append(';'.join(map(str, key)) + ";" + str(count) + ";" + str(count_pct))
+    return lines
+
+
+def pair_table_lines(table, labels=("layer1", "layer2")):
+    '''
+    Semicolon separated long-format table of a sparse comparison: one line per pair of classes
+    found, with its pixel count.
+    '''
+    keys, counts = table
+    lines = [';'.join(labels) + ";count"]
+    for (class_1, class_2), count in zip(keys, counts):
+        lines.append(str(class_1) + ";" + str(class_2) + ";" + str(count))
+    return lines
+
+
+def square_matrix(matrix, unique_1, unique_2):
+    '''
+    Aligns the rows (layer 1) and columns (layer 2) of a compact frequency matrix on the union of
+    the classes of both layers, so the agreement is on the diagonal.
+    Returns (square matrix, classes).
+    '''
+    classes = np.union1d(unique_1, unique_2)
+    square = np.zeros((classes.size, classes.size), dtype=np.int64)
+    rows = np.searchsorted(classes, unique_1)
+    cols = np.searchsorted(classes, unique_2)
+    square[np.ix_(rows, cols)] = matrix
+    return square, classes
+
+
+def agreement_metrics(square):
+    '''
+    Agreement metrics of a square frequency matrix (layer 1 in rows, layer 2 in columns).
+    square can hold a stack of matrices (..., classes, classes); every metric then has the
+    leading shape of the stack.
+        overall      : proportion of pixels on the diagonal
+        kappa        : Cohen's kappa
+        quantity     : quantity disagreement, 0.5 * sum(|row proportion - column proportion|)
+        allocation   : allocation disagreement, (1 - overall) - quantity
+        producer     : per class agreement relative to layer 1 (diagonal / row total)
+        user         : per class agreement relative to layer 2 (diagonal / column total)
+    '''
+    square = np.asarray(square, dtype=np.float64)
+    total = square.sum(axis=(-2, -1))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        prop = square / total[..., None, None]
+        diag = np.diagonal(prop, axis1=-2, axis2=-1)
+        row_prop = prop.sum(axis=-1)
+        col_prop = prop.sum(axis=-2)
+
+        overall = diag.sum(axis=-1)
+        expected = (row_prop * col_prop).sum(axis=-1)
+        kappa = (overall - expected) / (1 - expected)
+        quantity = 0.5 * np.abs(row_prop - col_prop).sum(axis=-1)
+        allocation = (1 - overall) - quantity
+        producer = diag / row_prop
+        user = diag / col_prop
+
+    return {"overall": overall, "kappa": kappa, "quantity": quantity, "allocation": allocation,
+            "producer": producer, "user": user}
+
+
+def bootstrap_metrics(square, n_samples, confidence=95, seed=None, chunk_size=100):
+    '''
+    Percentile bootstrap confidence intervals of the agreement metrics. Every sample is a
+    multinomial resampling of the matrix cells with the total number of pixels, so the pixels
+    themselves are never resampled. Returns {metric: (lower, upper)}.
+    '''
+    square = np.asarray(square, dtype=np.int64)
+    total = int(square.sum())
+    prop = (square / total).reshape(-1)
+    rng = np.random.default_rng(seed)
+
+    samples = {}
+    for first in range(0, n_samples, chunk_size):
+        size = min(chunk_size, n_samples - first)
+        stack = rng.multinomial(total, prop, size=size).reshape((size,) + square.shape)
+        for name, values in agreement_metrics(stack).items():
+            samples.setdefault(name, []).append(values)
+
+    tail = (100 - confidence) / 2
+    intervals = {}
+    for name, values in samples.items():
+        values = np.concatenate(values, axis=0)
+        with warnings.catch_warnings():
+            # classes absent from one of the layers have no producer or user agreement
+            warnings.simplefilter("ignore", RuntimeWarning)
+            lower, upper = np.nanpercentile(values, [tail, 100 - tail], axis=0)
+        intervals[name] = (lower, upper)
+    return intervals
+
+
+def agreement_metrics_lines(matrix, unique_1, unique_2, n_samples=0, confidence=95, seed=None):
+    '''
+    Semicolon separated agreement report of a compact frequency matrix: the global metrics,
+    then the producer and user agreement of every class. With n_samples > 0, the lower and upper
+    bounds of the bootstrap confidence interval are added to every metric.
+    '''
+    square, classes = square_matrix(matrix, unique_1, unique_2)
+    metrics = agreement_metrics(square)
+    intervals = None
+    if n_samples > 0:
+        intervals = bootstrap_metrics(square, n_samples, confidence, seed)
+
+    def fmt(value):
+        return str(np.round(value, 4))
+
+    lines = ["metric;value"]
+    if intervals is not None:
+        lines[0] = lines[0] + ";lower_" + str(confidence) + ";upper_" + str(confidence)
+    for name in ("overall", "kappa", "quantity", "allocation"):
+        line = name + ";" + fmt(metrics[name])
+        if intervals is not None:
+            line = line + ";" + fmt(intervals[name][0]) + ";" + fmt(intervals[name][1])
+        lines.append(line)
+
+    lines.append("\t")
+    header = "class;producer;user"
+    if intervals is not None:
+        header = (header + ";producer_lower;producer_upper;user_lower;user_upper")
+    lines.append(header)
+    for ii, cl in enumerate(classes):
+        line = str(cl) + ";" + fmt(metrics["producer"][ii]) + ";" + fmt(metrics["user"][ii])
+        if intervals is not None:
+            line = (line + ";" + fmt(intervals["producer"][0][ii]) + ";" + fmt(intervals["producer"][1][ii])
+                    + ";" + fmt(intervals["user"][0][ii]) + ";" + fmt(intervals["user"][1][ii]))
+        lines.append(line)
+    return lines
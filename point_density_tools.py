@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+'''----------------------------------------------------------------------
+ * - Copyright (c) 2023.  All rights reserved.                          -
+
+ * ----------------------------------------------------------------------
+'''
+# -----------------------------------------------------------------------------------------------------
+#  Point density of 2D scatter plots
+# -----------------------------------------------------------------------------------------------------
+'''
+gaussian_kde(xy)(xy) evaluates the kernel of every point at every point: the time grows with the
+square of the number of points.
+
+binned_density uses the same Gaussian kernel as gaussian_kde (Scott's rule bandwidth, full data
+covariance) on a grid: the points are whitened (decorrelated and scaled by the Cholesky factor
+of their covariance), spread on a grid_size x grid_size grid by linear binning, the grid is
+smoothed with a separable Gaussian filter and the density of every point is interpolated back
+from the grid. The time is linear in the number of points (plus the grid smoothing).
+
+neighbour_density estimates the density of every point from its own neighbours, found with a
+KD-tree (scipy.spatial.cKDTree) in the same whitened coordinates: the number of points within a
+radius, or the distance to the k-th nearest neighbour. It is O(n log n), the queries run in
+parallel (workers) and it is not blurred by the grid or the kernel bandwidth.
+'''
+import numpy as np
+from scipy import ndimage
+from scipy.spatial import cKDTree
+
+
+def _whiten(x, y):
+    # Points with an identity covariance, and the determinant of the transform
+    xy = np.vstack([x, y]).astype(np.float64)
+    xy -= xy.mean(axis=1)[:, None]
+    try:
+        chol = np.linalg.cholesky(np.cov(xy) if xy.shape[1] > 1 else np.zeros((2, 2)))
+    except np.linalg.LinAlgError:
+        # Singular covariance (e.g. y = a * x or a single point): the axes are only scaled
+        std = xy.std(axis=1)
+        chol = np.diag(np.where(std > 0, std, 1.0))
+    return np.linalg.solve(chol, xy), abs(np.linalg.det(chol))
+
+
+def binned_density(x, y, grid_size=512, bw_factor=None):
+    '''
+    Gaussian kernel density of every point (x, y 1D arrays of the same size), see the module notes.
+    bw_factor is the kernel bandwidth relative to the data standard deviation
+    (default: Scott's rule, n ** (-1 / 6), as gaussian_kde).
+    Returns the density of every point (float64 array), on the same scale as gaussian_kde.
+    '''
+    n_points = len(x)
+    if n_points == 0:
+        return np.zeros(0)
+    if bw_factor is None:
+        bw_factor = n_points ** (-1.0 / 6)
+    white, determinant = _whiten(x, y)
+
+    # Grid covering the points and 4 bandwidths around them
+    lower = white.min(axis=1) - 4 * bw_factor
+    upper = white.max(axis=1) + 4 * bw_factor
+    step = (upper - lower) / (grid_size - 1)
+    position = (white - lower[:, None]) / step[:, None]
+
+    # Linear binning: every point is shared between its 4 nearest grid nodes
+    first = np.minimum(np.floor(position).astype(np.int64), grid_size - 2)
+    fraction = position - first
+    grid = np.zeros(grid_size * grid_size)
+    for shift_x, shift_y in ((0, 0), (1, 0), (0, 1), (1, 1)):
+        weight_x = fraction[0] if shift_x else 1 - fraction[0]
+        weight_y = fraction[1] if shift_y else 1 - fraction[1]
+        nodes = (first[0] + shift_x) * grid_size + first[1] + shift_y
+        grid += np.bincount(nodes, weights=weight_x * weight_y, minlength=grid_size * grid_size)
+    grid = grid.reshape(grid_size, grid_size)
+
+    grid = ndimage.gaussian_filter(grid, sigma=bw_factor / step, mode="constant", truncate=4.0)
+    values = ndimage.map_coordinates(grid, position, order=1, mode="nearest")
+    return values / (n_points * step[0] * step[1] * determinant)
+
+
+def neighbour_density(x, y, neighbours=32, radius=None, workers=-1):
+    '''
+    Density of every point (x, y 1D arrays of the same size) from its neighbours in the whitened
+    coordinates (see the module notes):
+        radius None: neighbours / (n * pi * d ** 2), d being the distance to the neighbours-th
+                     nearest neighbour (the point itself excluded)
+        radius:      number of points within radius (in standard deviations of the data, the
+                     point itself included) / (n * pi * radius ** 2)
+    workers is the number of parallel query processes of cKDTree (-1: all the CPUs).
+    Returns the density of every point (float64 array), on the same scale as gaussian_kde.
+    '''
+    n_points = len(x)
+    if n_points == 0:
+        return np.zeros(0)
+    white, determinant = _whiten(x, y)
+    points = white.T
+    tree = cKDTree(points)
+
+    if radius is not None:
+        counts = tree.query_ball_point(points, radius, workers=workers, return_length=True)
+        return counts / (n_points * np.pi * radius * radius * determinant)
+
+    neighbours = min(int(neighbours), n_points - 1)
+    if neighbours < 1:
+        return np.ones(n_points)
+    distance = tree.query(points, k=[neighbours + 1], workers=workers)[0][:, 0]
+    # Duplicated points: the distance is limited to the smallest non-zero distance
+    positive = distance[distance > 0]
+    distance = np.maximum(distance, positive.min() if len(positive) > 0 else 1.0)
+    return neighbours / (n_points * np.pi * distance * distance * determinant)
@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+'''----------------------------------------------------------------------
+ * - Copyright (c) 2023.  All rights reserved.                          -
+
+ * ----------------------------------------------------------------------
+'''
+# -----------------------------------------------------------------------------------------------------
+#  Windowed (block by block) reading of raster channels with ds.BasicReader
+# -----------------------------------------------------------------------------------------------------
+'''
+The image is split into windows of block_lines lines (and block_pixels pixels if given) and only
+the requested channels are read for one window at a time. Peak memory is bounded by the block
+size rather than by the image size.
+
+Raster outputs are written the same way: create_raster_file creates the (empty) output file and
+write_raster_block writes one window at a time.
+'''
+import numpy as np
+
+from pci.api import datasource as ds
+from pci.api import gobs
+
+
+def iter_windows(width, height, block_lines, block_pixels=None, xoff=0, yoff=0, align_lines=False):
+    '''
+    Yields the (x, y, width, height) windows covering a width x height area starting at (xoff, yoff).
+    Windows are ordered line by line, from the top left corner.
+    With align_lines, the windows start on the multiples of block_lines counted from the first
+    line of the image (the first window is shorter when yoff is not a multiple), so the same
+    lines always fall in the same window whatever the area.
+    '''
+    block_lines = max(1, int(block_lines))
+    if block_pixels is None:
+        block_pixels = width
+    block_pixels = max(1, int(block_pixels))
+
+    starts = list(range(0, height, block_lines))
+    if align_lines is True and height > 0:
+        starts = [0] + [y for y in range(-yoff % block_lines, height, block_lines) if y > 0]
+    for y, end in zip(starts, starts[1:] + [height]):
+        win_height = end - y
+        for x in range(0, width, block_pixels):
+            win_width = min(block_pixels, width - x)
+            yield (xoff + x, yoff + y, win_width, win_height)
+
+
+def full_window(input_file):
+    '''
+    Returns the (0, 0, width, height) window covering the whole image.
+    '''
+    with ds.open_dataset(input_file, ds.eAM_READ) as dataset:
+        return (0, 0, dataset.width, dataset.height)
+
+
+def geocoding_transform(dataset):
+    '''
+    Affine transform of the dataset geocoding as (x0, dx, rx, y0, ry, dy), with
+        map_x = x0 + pixel * dx + line * rx
+        map_y = y0 + pixel * ry + line * dy
+    where (pixel, line) = (0, 0) is the upper left corner of the image.
+    '''
+    geocoding = dataset.geocoding
+    x0, y0 = geocoding.raster_to_map(0, 0)
+    x1, y1 = geocoding.raster_to_map(1, 0)
+    x2, y2 = geocoding.raster_to_map(0, 1)
+    return (x0, x1 - x0, x2 - x0, y0, y1 - y0, y2 - y0)
+
+
+def map_to_pixel(transform, map_x, map_y):
+    '''
+    Converts map coordinates to (fractional) pixel and line coordinates.
+    '''
+    x0, dx, rx, y0, ry, dy = transform
+    det = dx * dy - rx * ry
+    map_x = np.asarray(map_x, dtype=np.float64) - x0
+    map_y = np.asarray(map_y, dtype=np.float64) - y0
+    pixel = (dy * map_x - rx * map_y) / det
+    line = (dx * map_y - ry * map_x) / det
+    return pixel, line
+
+
+def pixel_to_map(transform, pixel, line):
+    '''
+    Converts (fractional) pixel and line coordinates to map coordinates.
+    '''
+    x0, dx, rx, y0, ry, dy = transform
+    pixel = np.asarray(pixel, dtype=np.float64)
+    line = np.asarray(line, dtype=np.float64)
+    return x0 + pixel * dx + line * rx, y0 + pixel * ry + line * dy
+
+
+def extents_to_window(transform, extents, width, height):
+    '''
+    Pixel window (x, y, width, height) covering the map extents (xmin, ymin, xmax, ymax),
+    limited to the image. Returns None if the extents do not overlap the image.
+    '''
+    xmin, ymin, xmax, ymax = extents
+    pixel, line = map_to_pixel(transform, [xmin, xmax, xmin, xmax], [ymin, ymin, ymax, ymax])
+    x_first = max(0, int(np.floor(pixel.min())))
+    y_first = max(0, int(np.floor(line.min())))
+    x_last = min(width, int(np.ceil(pixel.max())))
+    y_last = min(height, int(np.ceil(line.max())))
+    if x_last <= x_first or y_last <= y_first:
+        return None
+    return (x_first, y_first, x_last - x_first, y_last - y_first)
+
+
+def row_bands(width, height, n_bands, xoff=0, yoff=0, align_lines=None):
+    '''
+    Splits a width x height area into n_bands bands of full lines.
+    With align_lines, the band edges are moved to the multiples of align_lines counted from the
+    first line of the image (see iter_windows), which can give fewer bands.
+    Returns the list of (x, y, width, height) windows, from top to bottom.
+    '''
+    n_bands = max(1, min(int(n_bands), height))
+    edges = [(height * ii) // n_bands for ii in range(n_bands + 1)]
+    if align_lines is not None:
+        align_lines = max(1, int(align_lines))
+        inner = [((yoff + edge + align_lines // 2) // align_lines) * align_lines - yoff for edge in edges[1:-1]]
+        edges = [0] + sorted(set(edge for edge in inner if 0 < edge < height)) + [height]
+    return [(xoff, yoff + edges[ii], width, edges[ii + 1] - edges[ii]) for ii in range(len(edges) - 1)]
+
+
+def read_channel_blocks(input_file, channels, block_lines, block_pixels=None, window=None, align_lines=False):
+    '''
+    Reads the channels (1 based channel numbers) of input_file window by window.
+    window = (x, y, width, height) restricts the reading to a part of the image.
+    With align_lines, the windows are aligned on the image lines (see iter_windows).
+    Yields (x, y, data) where data is a (lines, pixels, len(channels)) numpy array.
+    '''
+    with ds.open_dataset(input_file, ds.eAM_READ) as dataset:
+        reader = ds.BasicReader(dataset, channels)
+        if window is None:
+            window = (0, 0, reader.width, reader.height)
+        xoff, yoff, width, height = window
+        for x, y, win_width, win_height in iter_windows(width, height, block_lines,
+                                                         block_pixels, xoff, yoff, align_lines):
+            raster = reader.read_raster(x, y, win_width, win_height)
+            yield x, y, raster.data
+
+
+def create_raster_file(output_file, width, height, n_channels, data_type, crs=None, geocoding=None):
+    '''
+    Creates an empty PCIDSK file of width x height pixels with n_channels channels of data_type
+    (gobs data type, e.g. gobs.DT_32S). The channels are initialized to 0.
+    '''
+    with ds.new_dataset(output_file, "PCIDSK", "") as dataset:
+        writer = ds.BasicWriter(dataset)
+        writer.create(gobs.RasterInfo(width, height, n_channels, data_type))
+        if crs is not None:
+            writer.crs = crs
+        if geocoding is not None:
+            writer.geocoding = geocoding
+
+
+def write_raster_block(output_file, x, y, data):
+    '''
+    Writes data, a (lines, pixels, channels) numpy array, to output_file with its upper left
+    corner at pixel x, line y.
+    '''
+    with ds.open_dataset(output_file, ds.eAM_WRITE) as dataset:
+        writer = ds.BasicWriter(dataset)
+        writer.write_raster(gobs.array_to_raster(data, x, y))
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+'''----------------------------------------------------------------------
+ * - Copyright (c) 2023.  All rights reserved.                          -
+
+ * ----------------------------------------------------------------------
+'''
+# -----------------------------------------------------------------------------------------------------
+#  Reading of the x and y values of the 2D scatter plots
+# -----------------------------------------------------------------------------------------------------
+'''
+CSV files are parsed with np.loadtxt: only the requested columns are converted, directly to
+float arrays, without building Python lists of strings.
+
+Rasters are read block by block (raster_block_io.read_channel_blocks), only the two requested
+channels. The invalid pairs are removed block by block and the valid pairs are copied into
+arrays allocated once for the whole image.
+
+A pair is valid when neither value is NoData and, optionally, both values are finite (no NaN or
+infinity) and inside the x and y ranges. The conditions are combined into one boolean mask
+(valid_pairs_mask) and every axis is indexed once with it, so the pairs stay aligned even when
+the two channels do not have their NoData at the same pixels.
+'''
+import numpy as np
+
+from raster_block_io import full_window, read_channel_blocks
+
+
+def read_csv_columns(input_file, columns, skip_header=True, dtype=np.float64, delimiter=","):
+    '''
+    Reads the columns (0 based column numbers) of a CSV file as dtype (e.g. np.float32).
+    With skip_header, the first line is not read.
+    Returns one 1D array per column, in the order of columns.
+    '''
+    data = np.loadtxt(input_file, dtype=dtype, delimiter=delimiter, skiprows=1 if skip_header else 0,
+                      usecols=columns, ndmin=2, quotechar='"')
+    return tuple(data[:, ii] for ii in range(len(columns)))
+
+
+def valid_pairs_mask(x, y, nodata_value=None, remove_nan=False, x_range=None, y_range=None):
+    '''
+    Boolean mask of the valid (x, y) pairs (1D arrays of the same size): neither value is
+    nodata_value, with remove_nan both values are finite, and x and y are inside
+    x_range and y_range = (min, max) (limits included, None: no limit).
+    '''
+    valid = np.ones(len(x), dtype=bool)
+    if nodata_value is not None:
+        valid &= x != nodata_value
+        valid &= y != nodata_value
+    if remove_nan is True:
+        valid &= np.isfinite(x)
+        valid &= np.isfinite(y)
+    for values, value_range in ((x, x_range), (y, y_range)):
+        if value_range is not None:
+            valid &= values >= value_range[0]
+            valid &= values <= value_range[1]
+    return valid
+
+
+def read_channel_pairs(input_file, channels, nodata_value=None, block_lines=1024, remove_nan=False,
+                       x_range=None, y_range=None):
+    '''
+    Reads the two channels (1 based channel numbers) of input_file block by block and keeps the
+    valid pairs (see valid_pairs_mask).
+    Returns (x, y, n_pixels, nodata_counts): the values of both channels for the pixels kept,
+    the number of pixels read and the number of nodata_value pixels of every channel.
+    '''
+    n_pixels = int(np.prod(full_window(input_file)[2:]))
+    nodata_counts = np.zeros(2, dtype=np.int64)
+    x = y = None
+    n_kept = 0
+
+    for _, _, block in read_channel_blocks(input_file, list(channels), block_lines):
+        block = block.reshape(-1, 2)
+        if x is None:
+            x = np.empty(n_pixels, dtype=block.dtype)
+            y = np.empty(n_pixels, dtype=block.dtype)
+        if nodata_value is not None:
+            nodata_counts += np.count_nonzero(block == nodata_value, axis=0)
+        valid = valid_pairs_mask(block[:, 0], block[:, 1], nodata_value, remove_nan, x_range, y_range)
+        n_valid = np.count_nonzero(valid)
+        x[n_kept:n_kept + n_valid] = block[valid, 0]
+        y[n_kept:n_kept + n_valid] = block[valid, 1]
+        n_kept += n_valid
+
+    if x is None:
+        return np.zeros(0), np.zeros(0), n_pixels, nodata_counts
+    return x[:n_kept], y[:n_kept], n_pixels, nodata_counts
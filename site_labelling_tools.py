@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+'''----------------------------------------------------------------------
+ * - Copyright (c) 2023.  All rights reserved.                          -
+
+ * ----------------------------------------------------------------------
+'''
+# -----------------------------------------------------------------------------------------------------
+#  Tile by tile connected component labelling of a binary or class raster (site IDs)
+# -----------------------------------------------------------------------------------------------------
+'''
+The raster is labelled tile by tile with scipy.ndimage.label, so only one tile is in memory at a
+time. Every tile gets its own range of provisional labels, written directly to the output file.
+The labels that touch across a tile seam (the last line / column of a tile and the first line /
+column of its neighbour) are recorded as pairs while the tiles are processed, and merged with a
+union-find (scipy.sparse.csgraph.connected_components) once all the tiles are labelled. A last
+pass over the output file replaces every provisional label by its final site ID with np.take.
+
+The final site IDs are numbered from 1, in the order of the first pixel of every site (tile by
+tile, line by line). 0 is the background.
+'''
+import numpy as np
+from scipy import ndimage
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+from raster_block_io import full_window, read_channel_blocks, write_raster_block
+
+
+def foreground_mask(block, label_classes=None, nodata_value=None):
+    '''
+    Pixels of the block that belong to a site: the values of label_classes, or every value but
+    nodata_value if label_classes is empty.
+    '''
+    if label_classes:
+        return np.isin(block, label_classes)
+    if nodata_value is not None:
+        return block != nodata_value
+    return np.ones(block.shape, dtype=bool)
+
+
+def label_block(block, foreground, by_class=True, connectivity=8):
+    '''
+    Connected components of the foreground pixels of one tile. With by_class, the neighbouring
+    pixels of different values are different components.
+    Returns (labels, label_values): the labels of the tile (1 to n, 0 is the background) and
+    the value of the block of every label (label_values[0] is for label 1).
+    '''
+    structure = ndimage.generate_binary_structure(2, 2 if connectivity == 8 else 1)
+    labels = np.zeros(block.shape, dtype=np.int64)
+    label_values = []
+    n_labels = 0
+    if by_class is True:
+        groups = np.unique(block[foreground])
+    else:
+        groups = [None]
+
+    for value in groups:
+        mask = foreground if value is None else foreground & (block == value)
+        group_labels, n_group = ndimage.label(mask, structure=structure)
+        labels[mask] = group_labels[mask] + n_labels
+        label_values.append(np.full(n_group, 0 if value is None else value, dtype=block.dtype))
+        n_labels += n_group
+
+    if not label_values:
+        return labels, np.zeros(0, dtype=block.dtype)
+    return labels, np.concatenate(label_values)
+
+
+def seam_pairs(strip_1, strip_2, connectivity=8):
+    '''
+    (n, 2) array of the label pairs that touch across a seam. strip_1 and strip_2 are the labels
+    on each side of the seam (last line / column of one tile, first line / column of the next).
+    '''
+    n = len(strip_1)
+    shifts = (-1, 0, 1) if connectivity == 8 else (0,)
+    pairs = []
+    for shift in shifts:
+        side_1 = strip_1[max(0, -shift):n - max(0, shift)]
+        side_2 = strip_2[max(0, shift):n - max(0, -shift)]
+        touch = (side_1 > 0) & (side_2 > 0)
+        pairs.append(np.column_stack((side_1[touch], side_2[touch])))
+    return np.unique(np.concatenate(pairs), axis=0)
+
+
+def merge_labels(n_labels, pairs, label_values=None):
+    '''
+    Union-find of the provisional labels 1 to n_labels joined by pairs. With label_values, only
+    the pairs of labels of the same value are joined.
+    Returns the mapping array (provisional label -> final site ID, 0 -> 0), the site IDs being
+    numbered from 1 in the order of their smallest provisional label.
+    '''
+    if label_values is not None and len(pairs) > 0:
+        pairs = pairs[label_values[pairs[:, 0] - 1] == label_values[pairs[:, 1] - 1]]
+    graph = coo_matrix((np.ones(len(pairs)), (pairs[:, 0], pairs[:, 1])),
+                       shape=(n_labels + 1, n_labels + 1))
+    n_components, component = connected_components(graph, directed=False)
+
+    # Number the sites in the order of their smallest provisional label
+    first_label = np.full(n_components, n_labels + 1, dtype=np.int64)
+    np.minimum.at(first_label, component, np.arange(n_labels + 1))
+    order = np.argsort(first_label, kind="stable")
+    rank = np.empty(n_components, dtype=np.int64)
+    rank[order] = np.arange(n_components)
+    # The background (label 0) is alone in its component and ranked first
+    return rank[component]
+
+
+def label_connected_sites(input_file, channel, output_file, window=None, block_lines=1024,
+                          block_pixels=None, label_classes=None, nodata_value=None, by_class=True,
+                          connectivity=8):
+    '''
+    Writes the site IDs (connected components, see label_block) of channel of input_file over
+    window = (x, y, width, height) (default: the whole image) to the first channel of output_file
+    (created beforehand with raster_block_io.create_raster_file, 32 bit signed), tile by tile.
+    Tiles are block_lines lines by block_pixels pixels (default: the window width).
+    Returns the number of sites.
+    '''
+    if window is None:
+        window = full_window(input_file)
+    xoff, yoff, width, height = window
+
+    n_labels = 0
+    label_values = []
+    pairs = [np.zeros((0, 2), dtype=np.int64)]
+    previous_bottom = None
+    current_top = np.zeros(width, dtype=np.int64)
+    current_bottom = np.zeros(width, dtype=np.int64)
+    previous_right = None
+    tile_line = None
+
+    for x, y, block in read_channel_blocks(input_file, [channel], block_lines, block_pixels, window):
+        block = block[:, :, 0]
+        if y != tile_line:
+            # New row of tiles: the seam with the previous row of tiles is complete
+            if tile_line is not None:
+                if previous_bottom is not None:
+                    pairs.append(seam_pairs(previous_bottom, current_top, connectivity))
+                previous_bottom = current_bottom
+                current_top = np.zeros(width, dtype=np.int64)
+                current_bottom = np.zeros(width, dtype=np.int64)
+            previous_right = None
+            tile_line = y
+
+        labels, values = label_block(block, foreground_mask(block, label_classes, nodata_value),
+                                     by_class, connectivity)
+        labels[labels > 0] += n_labels
+        n_labels += len(values)
+        label_values.append(values)
+        write_raster_block(output_file, x, y, labels.astype(np.int32)[:, :, None])
+
+        if previous_right is not None:
+            pairs.append(seam_pairs(previous_right, labels[:, 0], connectivity))
+        previous_right = labels[:, -1]
+        current_top[x - xoff:x - xoff + block.shape[1]] = labels[0]
+        current_bottom[x - xoff:x - xoff + block.shape[1]] = labels[-1]
+
+    if previous_bottom is not None:
+        pairs.append(seam_pairs(previous_bottom, current_top, connectivity))
+
+    values = np.concatenate(label_values) if label_values else np.zeros(0)
+    mapping = merge_labels(n_labels, np.concatenate(pairs).astype(np.int64),
+                           values if by_class is True else None)
+
+    # Final site IDs
+    for x, y, block in read_channel_blocks(output_file, [1], block_lines, block_pixels, window):
+        write_raster_block(output_file, x, y, np.take(mapping, block).astype(np.int32))
+
+    return int(mapping.max()) if len(mapping) else 0
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+'''----------------------------------------------------------------------
+ * - Copyright (c) 2023.  All rights reserved.                          -
+
+ * ----------------------------------------------------------------------
+'''
+# -----------------------------------------------------------------------------------------------------
+#  Columnar (binary or CSV) output of the site tables and the confusion matrices
+# -----------------------------------------------------------------------------------------------------
+'''
+The tables are written directly from their numpy arrays, without building text lines:
+    npz : one NumPy archive (np.savez), read back with np.load
+    npy : one .npy file per column in a <name>_npy folder, that can be memory-mapped with
+          np.load(..., mmap_mode="r")
+    csv : comma separated file written in bulk with np.savetxt
+'''
+import os
+
+import numpy as np
+
+table_format_list = ["npz", "npy", "csv"]
+
+
+def _csv_format(array):
+    # Integers are written as integers, the other values with 10 significant digits
+    return "%d" if np.asarray(array).dtype.kind in "uib" else "%.10g"
+
+
+def write_table(base_name, columns, formats):
+    '''
+    Writes the columns, a list of (name, 1D array) of the same length, in every format of formats
+    (see table_format_list): base_name.npz, base_name_npy/<name>.npy and base_name.csv.
+    Returns the list of the files (or folders) written.
+    '''
+    names = [name for name, _ in columns]
+    arrays = [np.asarray(array) for _, array in columns]
+    written = []
+
+    if "npz" in formats:
+        np.savez(base_name + ".npz", **dict(zip(names, arrays)))
+        written.append(base_name + ".npz")
+
+    if "npy" in formats:
+        folder = base_name + "_npy"
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        for name, array in zip(names, arrays):
+            np.save(os.path.join(folder, name + ".npy"), array)
+        written.append(folder)
+
+    if "csv" in formats:
+        np.savetxt(base_name + ".csv", np.column_stack(arrays), fmt=[_csv_format(array) for array in arrays],
+                   delimiter=",", header=",".join(names), comments="")
+        written.append(base_name + ".csv")
+
+    return written
+
+
+def write_matrix(base_name, matrix, classes_1, classes_2, formats):
+    '''
+    Writes a frequency matrix (classes_1 in rows, classes_2 in columns) in every format of formats:
+    the npz and npy outputs hold the arrays matrix, classes_1 and classes_2; the csv output is the
+    matrix with the classes of layer 1 in the first column and the classes of layer 2 in the header.
+    Returns the list of the files (or folders) written.
+    '''
+    columns = [("matrix", matrix), ("classes_1", classes_1), ("classes_2", classes_2)]
+    written = write_table(base_name, columns, [output for output in formats if output != "csv"])
+
+    if "csv" in formats:
+        classes_1 = np.asarray(classes_1)
+        matrix = np.asarray(matrix).reshape(len(classes_1), len(classes_2))
+        header = "class," + ",".join(str(value) for value in np.asarray(classes_2).tolist())
+        np.savetxt(base_name + ".csv", np.column_stack((classes_1, matrix)),
+                   fmt=[_csv_format(classes_1)] + [_csv_format(matrix)] * len(classes_2),
+                   delimiter=",", header=header, comments="")
+        written.append(base_name + ".csv")
+
+    return written
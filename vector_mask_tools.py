@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+'''----------------------------------------------------------------------
+ * - Copyright (c) 2023.  All rights reserved.                          -
+
+ * ----------------------------------------------------------------------
+'''
+# -----------------------------------------------------------------------------------------------------
+#  Subset vector layers: reading of the shapes, extents and rasterization to a boolean mask
+# -----------------------------------------------------------------------------------------------------
+'''
+The polygons of a vector segment are read with get_vector_io. Their extents give the pixel window
+to read directly from the source database instead of clipping it to an intermediate file.
+
+The polygons are rasterized as horizontal spans: for every image line, the [start, end) pixel
+ranges whose pixel centres are inside a polygon (even-odd rule inside a shape, so holes are
+excluded; union between shapes). The spans are small compared to a full mask, they can be
+cached on disk (keyed by the vector file and the raster geocoding) and the boolean mask of any
+block is built from them while streaming.
+
+The vertices are used as they are: the vector segment must be in the coordinate system of the
+raster (check_same_crs). Unlike CLIP, the vertices are not reprojected.
+'''
+import hashlib
+import os
+
+import numpy as np
+
+from pci.api import datasource as ds
+
+from raster_block_io import extents_to_window, map_to_pixel
+
+
+def read_vector_shapes(vector_file, segment):
+    '''
+    Reads the shapes of a vector segment. Returns a list of shapes, every shape being a list of
+    rings stored as (n, 2) numpy arrays of map coordinates.
+    '''
+    shapes = []
+    with ds.open_dataset(vector_file, ds.eAM_READ) as dataset:
+        vector_io = dataset.get_vector_io(segment)
+        for shape in vector_io:
+            rings = []
+            for ring in shape.geometry.rings:
+                vertices = np.asarray([(vertex[0], vertex[1]) for vertex in ring], dtype=np.float64)
+                if len(vertices) > 0:
+                    rings.append(vertices)
+            if rings:
+                shapes.append(rings)
+    return shapes
+
+
+def read_vector_crs(vector_file, segment):
+    '''
+    Coordinate system of a vector segment, None if it is not available.
+    '''
+    with ds.open_dataset(vector_file, ds.eAM_READ) as dataset:
+        return getattr(dataset.get_vector_io(segment), "crs", None)
+
+
+def crs_text(crs):
+    '''
+    Normalized text of a coordinate system (None: unknown), used to compare coordinate systems.
+    '''
+    if crs is None:
+        return None
+    text = " ".join(str(crs).split()).upper()
+    return text or None
+
+
+def check_same_crs(vector_crs, raster_crs):
+    '''
+    Raises a ValueError if the coordinate systems of the vector segment and of the raster are
+    both known and different.
+    '''
+    vector_text = crs_text(vector_crs)
+    raster_text = crs_text(raster_crs)
+    if vector_text is not None and raster_text is not None and vector_text != raster_text:
+        raise ValueError("the coordinate system of the subset vector layer (" + vector_text +
+                         ") is not the coordinate system of the raster (" + raster_text +
+                         "), reproject the vector layer or use direct_read = 'no'")
+
+
+def shapes_extents(shapes):
+    '''
+    Map extents (xmin, ymin, xmax, ymax) of a list of shapes.
+    '''
+    vertices = np.concatenate([ring for rings in shapes for ring in rings])
+    return (vertices[:, 0].min(), vertices[:, 1].min(), vertices[:, 0].max(), vertices[:, 1].max())
+
+
+def polygon_spans(shapes, transform, window):
+    '''
+    Rasterizes the shapes over window = (x, y, width, height) of a raster with the given
+    geocoding transform (see raster_block_io.geocoding_transform).
+    Returns (lines, starts, ends): pixel [starts, ends) of lines are inside a polygon.
+    Lines and pixels are image coordinates, limited to the window.
+    '''
+    xoff, yoff, width, height = window
+    x0_list, y0_list, x1_list, y1_list, shape_list = [], [], [], [], []
+    for shape_id, rings in enumerate(shapes):
+        for ring in rings:
+            pixel, line = map_to_pixel(transform, ring[:, 0], ring[:, 1])
+            pixel = pixel - xoff
+            line = line - yoff
+            # close the ring
+            x0_list.append(pixel)
+            y0_list.append(line)
+            x1_list.append(np.roll(pixel, -1))
+            y1_list.append(np.roll(line, -1))
+            shape_list.append(np.full(len(pixel), shape_id, dtype=np.int64))
+
+    empty = np.zeros(0, dtype=np.int64)
+    if not x0_list:
+        return empty, empty, empty
+
+    x0 = np.concatenate(x0_list)
+    y0 = np.concatenate(y0_list)
+    x1 = np.concatenate(x1_list)
+    y1 = np.concatenate(y1_list)
+    shape_id = np.concatenate(shape_list)
+
+    # Line centres (line + 0.5) crossed by every edge, half open rule [ymin, ymax)
+    ymin = np.minimum(y0, y1)
+    ymax = np.maximum(y0, y1)
+    first_line = np.maximum(np.ceil(ymin - 0.5), 0).astype(np.int64)
+    last_line = np.minimum(np.ceil(ymax - 0.5), height).astype(np.int64)
+    n_cross = np.maximum(last_line - first_line, 0)
+    n_cross[y0 == y1] = 0
+
+    edge = np.repeat(np.arange(len(x0)), n_cross)
+    if edge.size == 0:
+        return empty, empty, empty
+    edge_start = np.cumsum(n_cross) - n_cross
+    lines = first_line[edge] + (np.arange(edge.size) - edge_start[edge])
+    yc = lines + 0.5
+    xc = x0[edge] + (yc - y0[edge]) * (x1[edge] - x0[edge]) / (y1[edge] - y0[edge])
+
+    # Sort the crossings by shape, line and position: consecutive pairs are the inside spans
+    order = np.lexsort((xc, lines, shape_id[edge]))
+    lines = lines[order][0::2]
+    starts = np.ceil(xc[order][0::2] - 0.5)
+    ends = np.ceil(xc[order][1::2] - 0.5)
+
+    starts = np.clip(starts, 0, width).astype(np.int64)
+    ends = np.clip(ends, 0, width).astype(np.int64)
+    keep = ends > starts
+    return lines[keep] + yoff, starts[keep] + xoff, ends[keep] + xoff
+
+
+def spans_to_mask(spans, block_window):
+    '''
+    Boolean mask of block_window = (x, y, width, height), in image coordinates.
+    '''
+    lines, starts, ends = spans
+    bx, by, bwidth, bheight = block_window
+    select = (lines >= by) & (lines < by + bheight)
+    lines = lines[select] - by
+    starts = np.clip(starts[select] - bx, 0, bwidth)
+    ends = np.clip(ends[select] - bx, 0, bwidth)
+    keep = ends > starts
+
+    diff = np.zeros((bheight, bwidth + 1), dtype=np.int32)
+    np.add.at(diff, (lines[keep], starts[keep]), 1)
+    np.add.at(diff, (lines[keep], ends[keep]), -1)
+    return np.cumsum(diff[:, :bwidth], axis=1) > 0
+
+
+def subset_mask_spans(vector_file, segment, transform, width, height, cache_folder=None, raster_crs=None):
+    '''
+    Pixel window of the extents of a vector segment over a width x height raster with the given
+    geocoding transform, and the polygon_spans of its shapes over that window.
+    Returns (window, spans); window is None if the shapes do not overlap the raster.
+    With raster_crs (the coordinate system of the raster), a ValueError is raised if the vector
+    segment is in another coordinate system (see check_same_crs).
+    If cache_folder is given, the result is stored in a .npz file keyed by the vector file (path,
+    size and modification time), the segment and the raster geocoding, and reused by the next runs.
+    '''
+    if raster_crs is not None:
+        check_same_crs(read_vector_crs(vector_file, segment), raster_crs)
+
+    cache_file = None
+    if cache_folder:
+        key = repr((os.path.abspath(vector_file), os.path.getsize(vector_file),
+                    os.path.getmtime(vector_file), segment,
+                    tuple(float(ii) for ii in transform), int(width), int(height)))
+        cache_file = os.path.join(cache_folder, "subset_mask_" +
+                                  hashlib.sha1(key.encode("utf-8")).hexdigest() + ".npz")
+        if os.path.exists(cache_file):
+            with np.load(cache_file) as cached:
+                window = tuple(int(ii) for ii in cached["window"])
+                return window, (cached["lines"], cached["starts"], cached["ends"])
+
+    shapes = read_vector_shapes(vector_file, segment)
+    if not shapes:
+        return None, None
+    window = extents_to_window(transform, shapes_extents(shapes), width, height)
+    if window is None:
+        return None, None
+    spans = polygon_spans(shapes, transform, window)
+
+    if cache_file is not None:
+        if not os.path.exists(cache_folder):
+            os.makedirs(cache_folder)
+        np.savez(cache_file, window=np.asarray(window), lines=spans[0], starts=spans[1], ends=spans[2])
+    return window, spans
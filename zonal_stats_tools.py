@@ -0,0 +1,722 @@
+#!/usr/bin/env python
+'''----------------------------------------------------------------------
+ * - Copyright (c) 2023.  All rights reserved.                          -
+
+ * ----------------------------------------------------------------------
+'''
+# -----------------------------------------------------------------------------------------------------
+#  Zonal (per site ID) statistics engine
+# -----------------------------------------------------------------------------------------------------
+'''
+The site IDs and the classes are relabelled once with np.unique(return_inverse=True), every
+(site, class) pair is encoded into one combined index
+    code = site_index * number_of_classes + class_index
+and all the per site class histograms are counted in one pass (np.bincount, or np.unique on the
+codes when the number of sites x classes is too large). The result is a long-format table sorted
+by site then class, so the histogram of every site is a contiguous slice of the table.
+
+For block processing, the table of every block is merged into a running table with
+merge_histograms: the (site, class) pairs of both tables are grouped again and their counts
+summed, so the sites that span several blocks are counted exactly.
+parallel_zonal_histogram splits the image into row bands that are read and counted by a pool of
+worker processes; only the small partial tables are sent back and merged in band order.
+
+Continuous layers (value channels) are summarized by per site moments: count, mean, sum of the
+squared deviations (m2), min and max (value_moments). Their size only grows with the number of
+sites, not of pixels. Block and band moments are merged by reducing the concatenated moments
+again, with the pairwise update of the mean and m2 (Chan et al.), so the count, mean, min, max
+and standard deviation are exact for any block size. The exact median needs all the values of a
+site: with median, the (site, value) samples of every block are only collected, and they are
+sorted once at the end (zonal_value_statistics). Their memory grows with the number of pixels.
+
+Several class channels (e.g. the classifications of several years) are counted against the
+site IDs in the same pass, one table per channel. Their per pixel trajectory codes (the classes
+of all the channels combined into one integer, see trajectory_codes) are counted the same way.
+
+The location of every site (pixel bounding box, centroid and area) is aggregated the same way:
+the pixels are sorted by site and the extents of every site are reduced with np.minimum.reduceat,
+np.maximum.reduceat and np.add.reduceat (site_extents); block and band extents are merged by
+reducing the concatenated extents again.
+
+The partial results of every block can be cached on disk, keyed by a hash of the block pixels
+(tile_cache_key). When only a part of the layers changed since the last run, only the blocks
+whose pixels changed are counted again; the other partial results are loaded and merged. The
+blocks start on the multiples of block_lines counted from the first line of the image, and the
+row bands are cut on the same lines, so the tiles do not depend on the number of workers. The
+tile files that a run did not use (e.g. of another block_lines) are deleted at the end of the run.
+
+Per site results (e.g. the majority class) are painted back to rasters block by block: the
+position of every pixel's site in the sorted site list is found with np.searchsorted and the
+values are gathered with a single np.take.
+'''
+import glob
+import hashlib
+import itertools
+import multiprocessing
+import os
+
+import numpy as np
+
+from raster_block_io import full_window, iter_windows, pixel_to_map, read_channel_blocks, row_bands
+from raster_block_io import write_raster_block
+from vector_mask_tools import spans_to_mask
+
+# Largest number of (site, class) cells counted directly with np.bincount.
+max_direct_cells = 2 ** 24
+
+
+def zonal_histogram(site_ids, classes, counts=None):
+    '''
+    Per site class histogram of the pixels (site_ids and classes are 1D arrays of the same size).
+    With counts, every (site_ids, classes) entry counts for its value instead of 1.
+    Returns (sites, site_classes, counts): one entry per (site, class) pair present, sorted by
+    site then class. sites and site_classes keep the data type of the input layers.
+    '''
+    unique_sites, site_index = np.unique(site_ids, return_inverse=True)
+    unique_classes, class_index = np.unique(classes, return_inverse=True)
+    n_classes = max(1, len(unique_classes))
+
+    codes = site_index.reshape(-1).astype(np.int64) * n_classes + class_index.reshape(-1)
+    if len(unique_sites) * n_classes <= max_direct_cells:
+        sums = np.bincount(codes, weights=counts, minlength=len(unique_sites) * n_classes)
+        codes = np.flatnonzero(sums)
+        sums = sums[codes]
+    else:
+        codes, inverse = np.unique(codes, return_inverse=True)
+        sums = np.bincount(inverse.reshape(-1), weights=counts, minlength=len(codes))
+
+    return unique_sites[codes // n_classes], unique_classes[codes % n_classes], sums.astype(np.int64)
+
+
+def merge_histograms(table_1, table_2):
+    '''
+    Merges two (sites, site_classes, counts) tables of zonal_histogram (None is an empty table).
+    '''
+    if table_1 is None:
+        return table_2
+    if table_2 is None:
+        return table_1
+    return zonal_histogram(np.concatenate([table_1[0], table_2[0]]),
+                           np.concatenate([table_1[1], table_2[1]]),
+                           np.concatenate([table_1[2], table_2[2]]))
+
+
+def site_majority(sites, site_classes, counts):
+    '''
+    Majority class of every site of a (sites, site_classes, counts) table (see zonal_histogram).
+    Returns a dictionary of arrays, one entry per site:
+        site, majority (most frequent class, the lowest class for ties), purity (fraction of the
+        pixels of the site in the majority class), classes (number of classes) and count (pixels).
+    '''
+    site_ids, starts, ends = site_slices(sites)
+    if len(site_ids) == 0:
+        return {"site": site_ids, "majority": site_classes[:0], "purity": np.zeros(0),
+                "classes": np.zeros(0, dtype=np.int64), "count": np.zeros(0, dtype=np.int64)}
+
+    lengths = ends - starts
+    total = np.add.reduceat(counts, starts)
+    largest = np.maximum.reduceat(counts, starts)
+    # First entry of every site with the largest count (classes are sorted within a site)
+    candidates = np.flatnonzero(counts == np.repeat(largest, lengths))
+    group = np.repeat(np.arange(len(site_ids)), lengths)[candidates]
+    first = candidates[np.unique(group, return_index=True)[1]]
+
+    return {"site": site_ids, "majority": site_classes[first], "purity": largest / total,
+            "classes": lengths.astype(np.int64), "count": total}
+
+
+def site_majority_lines(majority):
+    '''
+    Semicolon separated table with one line per site: site; majority class; purity; number of
+    classes; pixel count.
+    '''
+    lines = ["site;majority;purity;classes;count"]
+    purity = np.round(majority["purity"], 6).tolist()
+    for site_id, major, site_purity, classes, count in zip(majority["site"], majority["majority"].tolist(),
+                                                           purity, majority["classes"].tolist(),
+                                                           majority["count"].tolist()):
+        lines.append(str(site_id) + ";" + str(major) + ";" + str(site_purity) + ";" + str(classes)
+                     + ";" + str(count))
+    return lines
+
+
+def paint_sites(site_block, site_list, site_values, fill_value=0):
+    '''
+    Paints per site values back to a block of site IDs. site_list is sorted and site_values is a
+    (sites, channels) array. The pixels whose site is not in site_list are set to fill_value.
+    Returns a (lines, pixels, channels) array.
+    '''
+    site_values = np.asarray(site_values)
+    if len(site_list) == 0:
+        return np.full(site_block.shape + site_values.shape[1:], fill_value, dtype=site_values.dtype)
+    position = np.searchsorted(site_list, site_block)
+    position = np.minimum(position, len(site_list) - 1)
+    found = site_list[position] == site_block
+    painted = np.take(site_values, position, axis=0)
+    painted[~found] = fill_value
+    return painted
+
+
+def write_site_raster(input_file, site_channel, window, block_lines, output_file, site_list, site_values,
+                      spans=None, fill_value=0):
+    '''
+    Writes the per site values (see paint_sites) to output_file (created beforehand with
+    raster_block_io.create_raster_file), reading the site ID channel of input_file block by block
+    over window. With spans, the pixels outside the subset polygons are set to fill_value.
+    '''
+    for xoff, yoff, block in read_channel_blocks(input_file, [site_channel], block_lines, window=window):
+        painted = paint_sites(block[:, :, 0], site_list, site_values, fill_value)
+        if spans is not None:
+            painted[~spans_to_mask(spans, (xoff, yoff, block.shape[1], block.shape[0]))] = fill_value
+        write_raster_block(output_file, xoff, yoff, painted)
+
+
+def trajectory_codes(classes, trajectory_factor):
+    '''
+    Trajectory code of every row of classes, a (pixels, channels) array of integer classes:
+        class_1 * factor ** (n - 1) + class_2 * factor ** (n - 2) + ... + class_n
+    e.g. 3, 1, 2 -> 30102 with trajectory_factor = 100.
+    '''
+    if classes.size and (classes.min() < 0 or classes.max() >= trajectory_factor):
+        raise ValueError("classes must be between 0 and trajectory_factor - 1")
+    if int(trajectory_factor) ** classes.shape[1] > np.iinfo(np.int64).max:
+        raise ValueError("trajectory codes do not fit in 64 bit signed integers")
+    codes = np.zeros(len(classes), dtype=np.int64)
+    for column in range(classes.shape[1]):
+        codes = codes * trajectory_factor + classes[:, column]
+    return codes
+
+
+def class_histograms(site_ids, classes, trajectory_factor=None):
+    '''
+    (sites, site_classes, counts) table (see zonal_histogram) of every column of classes, a
+    (pixels, channels) array. With trajectory_factor, the table of the trajectory codes
+    (see trajectory_codes) is added at the end of the list.
+    '''
+    tables = [zonal_histogram(site_ids, classes[:, column]) for column in range(classes.shape[1])]
+    if trajectory_factor is not None:
+        tables.append(zonal_histogram(site_ids, trajectory_codes(classes, trajectory_factor)))
+    return tables
+
+
+# Columns of the value moments (see value_moments)
+moment_names = ("count", "mean", "m2", "min", "max")
+
+
+def _reduce_moments(site_ids, columns):
+    order = np.argsort(site_ids, kind="stable")
+    site_values, starts, ends = site_slices(site_ids[order])
+    count, mean, m2, low, high = (columns[name][order] for name in moment_names)
+    moments = {"site": site_values}
+    if len(starts) == 0:
+        moments.update(zip(moment_names, (count, mean, m2, low, high)))
+        return moments
+    total = np.add.reduceat(count, starts)
+    total_mean = np.add.reduceat(count * mean, starts) / total
+    deviation = mean - np.repeat(total_mean, ends - starts)
+    moments.update(zip(moment_names, (total, total_mean,
+                                      np.add.reduceat(m2 + count * deviation * deviation, starts),
+                                      np.minimum.reduceat(low, starts), np.maximum.reduceat(high, starts))))
+    return moments
+
+
+def value_moments(site_ids, values, value_nodata=None, median=False):
+    '''
+    Per site moments of every column of values, a (pixels, channels) array. NaN and value_nodata
+    values are not used.
+    Returns one dictionary of arrays per channel, one entry per site (sorted):
+        site, count, mean, m2 (sum of the squared deviations from the mean), min and max.
+    With median, the entries samples_site and samples_value are added: lists of the site IDs and
+    values of the valid pixels, for the median (see zonal_value_statistics).
+    '''
+    channel_moments = []
+    for column in range(values.shape[1]):
+        layer = values[:, column]
+        valid = layer == layer
+        if value_nodata is not None:
+            valid &= layer != value_nodata
+        layer_ids = np.asarray(site_ids)[valid]
+        layer = layer[valid]
+        columns = {"count": np.ones(len(layer), dtype=np.int64), "mean": layer.astype(np.float64),
+                   "m2": np.zeros(len(layer)), "min": layer, "max": layer}
+        moments = _reduce_moments(layer_ids, columns)
+        if median is True:
+            moments["samples_site"] = [layer_ids]
+            moments["samples_value"] = [layer]
+        channel_moments.append(moments)
+    return channel_moments
+
+
+def merge_moments(moments_1, moments_2):
+    '''
+    Merges two value moments of value_moments (None is empty). The median samples are only
+    appended to each other, they are sorted once by zonal_value_statistics.
+    '''
+    if moments_1 is None:
+        return moments_2
+    if moments_2 is None:
+        return moments_1
+    columns = {name: np.concatenate([moments_1[name], moments_2[name]]) for name in ("site",) + moment_names}
+    moments = _reduce_moments(columns["site"], columns)
+    for name in ("samples_site", "samples_value"):
+        if name in moments_1:
+            moments[name] = moments_1[name] + moments_2[name]
+    return moments
+
+
+def zonal_value_statistics(moments):
+    '''
+    Per site statistics of a continuous layer from its moments (see value_moments).
+    Returns a dictionary of arrays, one entry per site:
+        site, count, mean, min, max, std (population standard deviation) and, when the moments
+        hold the median samples, median.
+    '''
+    count = moments["count"]
+    statistics = {"site": moments["site"], "count": count, "mean": moments["mean"],
+                  "min": moments["min"].astype(np.float64), "max": moments["max"].astype(np.float64),
+                  "std": np.sqrt(moments["m2"] / np.maximum(count, 1))}
+
+    if "samples_site" in moments:
+        # Median: the middle value(s) of every site, after a single sort of all the samples
+        sample_sites = np.concatenate(moments["samples_site"])
+        sample_values = np.concatenate(moments["samples_value"]).astype(np.float64)
+        order = np.lexsort((sample_values, sample_sites))
+        sample_values = sample_values[order]
+        starts = site_slices(sample_sites[order])[1]
+        statistics["median"] = (sample_values[starts + (count - 1) // 2] + sample_values[starts + count // 2]) / 2
+    return statistics
+
+
+def site_statistics_columns(site_list, statistics, labels):
+    '''
+    Columns (list of (name, array)) of the per site table of the value channels: the site of
+    site_list and, for every value channel (statistics and labels, see zonal_value_statistics),
+    its count, mean, min, max, std and median (if computed). The sites without any valid value have
+    a count of 0 and nan statistics.
+    '''
+    columns = [("site", np.asarray(site_list))]
+    for label, channel_stats in zip(labels, statistics):
+        names = [name for name in ("count", "mean", "min", "max", "std", "median") if name in channel_stats]
+        position = np.searchsorted(channel_stats["site"], site_list)
+        position = np.minimum(position, max(0, len(channel_stats["site"]) - 1))
+        found = np.zeros(len(site_list), dtype=bool)
+        if len(channel_stats["site"]) > 0:
+            found = channel_stats["site"][position] == site_list
+        for name in names:
+            column = np.full(len(site_list), 0 if name == "count" else np.nan)
+            if len(channel_stats["site"]) > 0:
+                column[found] = channel_stats[name][position[found]]
+            if name == "count":
+                column = column.astype(np.int64)
+            columns.append((label + "_" + name, column))
+    return columns
+
+
+def site_statistics_lines(site_list, statistics, labels):
+    '''
+    Semicolon separated table with one line per site of site_list, see site_statistics_columns.
+    '''
+    columns = site_statistics_columns(site_list, statistics, labels)
+    header = [name for name, _ in columns]
+    values = [column.tolist() if column.dtype.kind in "iu" else np.round(column, 6).tolist()
+              for _, column in columns[1:]]
+
+    lines = [";".join(header)]
+    for ii, site_id in enumerate(site_list):
+        lines.append(str(site_id) + ";" + ";".join(str(column[ii]) for column in values))
+    return lines
+
+
+# Reduction of every column of the site extents (see site_extents)
+extent_reductions = (("count", np.add), ("pixel_min", np.minimum), ("pixel_max", np.maximum),
+                     ("line_min", np.minimum), ("line_max", np.maximum), ("pixel_sum", np.add),
+                     ("line_sum", np.add))
+
+
+def _reduce_extents(site_ids, columns):
+    order = np.argsort(site_ids, kind="stable")
+    site_values, starts, _ = site_slices(site_ids[order])
+    extents = {"site": site_values}
+    for name, reduction in extent_reductions:
+        column = columns[name][order]
+        extents[name] = reduction.reduceat(column, starts) if len(starts) > 0 else column
+    return extents
+
+
+def site_extents(site_ids, pixels, lines):
+    '''
+    Extents of every site of the pixels (site_ids, pixels and lines are 1D arrays of the same
+    size: the site ID, pixel and line of every pixel).
+    Returns a dictionary of arrays, one entry per site (sorted):
+        site, count, pixel_min, pixel_max, line_min, line_max, pixel_sum and line_sum (sums of
+        the pixel and line coordinates, for the centroid).
+    '''
+    pixels = np.asarray(pixels, dtype=np.int64)
+    lines = np.asarray(lines, dtype=np.int64)
+    columns = {"count": np.ones(len(site_ids), dtype=np.int64), "pixel_min": pixels,
+               "pixel_max": pixels, "line_min": lines, "line_max": lines,
+               "pixel_sum": pixels.astype(np.float64), "line_sum": lines.astype(np.float64)}
+    return _reduce_extents(np.asarray(site_ids), columns)
+
+
+def merge_extents(extents_1, extents_2):
+    '''
+    Merges two site extents of site_extents (None is empty).
+    '''
+    if extents_1 is None:
+        return extents_2
+    if extents_2 is None:
+        return extents_1
+    columns = {name: np.concatenate([extents_1[name], extents_2[name]]) for name in extents_1}
+    return _reduce_extents(columns["site"], columns)
+
+
+def site_geometry(extents, transform=None):
+    '''
+    Location of every site from its extents (see site_extents).
+    Returns a dictionary of arrays, one entry per site:
+        site, count (pixels), pixel_min, line_min, pixel_max, line_max (bounding box, inclusive),
+        centroid_pixel and centroid_line (mean pixel and line of the site).
+    With transform (see raster_block_io.geocoding_transform), also:
+        centroid_x and centroid_y (map coordinates of the centroid, pixel centre convention) and
+        area (count x pixel area, in map units).
+    '''
+    count = extents["count"]
+    geometry = {"site": extents["site"], "count": count}
+    for name in ("pixel_min", "line_min", "pixel_max", "line_max"):
+        geometry[name] = extents[name]
+    geometry["centroid_pixel"] = extents["pixel_sum"] / np.maximum(count, 1)
+    geometry["centroid_line"] = extents["line_sum"] / np.maximum(count, 1)
+
+    if transform is not None:
+        x0, dx, rx, y0, ry, dy = transform
+        geometry["centroid_x"], geometry["centroid_y"] = pixel_to_map(transform, geometry["centroid_pixel"] + 0.5,
+                                                                      geometry["centroid_line"] + 0.5)
+        geometry["area"] = count * abs(dx * dy - rx * ry)
+    return geometry
+
+
+def site_geometry_lines(geometry):
+    '''
+    Semicolon separated table with one line per site and one column per entry of geometry
+    (see site_geometry).
+    '''
+    columns = [column.tolist() if column.dtype.kind in "iu" else np.round(column, 6).tolist()
+               for column in geometry.values()]
+    columns[0] = geometry["site"]
+    lines = [";".join(geometry)]
+    for row in zip(*columns):
+        lines.append(";".join(str(value) for value in row))
+    return lines
+
+
+def site_class_blocks(input_file, channels, block_lines, window, site_file=None, align_lines=False):
+    '''
+    Reads channels = [site ID channel, class channel(s)] of input_file block by block over window
+    (aligned on the image lines with align_lines, see raster_block_io.iter_windows).
+    With site_file, the site IDs are read from channels[0] of site_file (same size as input_file),
+    the classes from channels[1:] of input_file.
+    Yields (x, y, site_ids, classes), site_ids being a (lines, pixels) array and classes a
+    (lines, pixels, class channels) array.
+    '''
+    if site_file is None:
+        for xoff, yoff, block in read_channel_blocks(input_file, channels, block_lines, window=window,
+                                                     align_lines=align_lines):
+            yield xoff, yoff, block[:, :, 0], block[:, :, 1:]
+    else:
+        site_blocks = read_channel_blocks(site_file, channels[:1], block_lines, window=window,
+                                          align_lines=align_lines)
+        class_blocks = read_channel_blocks(input_file, channels[1:], block_lines, window=window,
+                                           align_lines=align_lines)
+        for (xoff, yoff, site_block), (_, _, class_block) in zip(site_blocks, class_blocks):
+            yield xoff, yoff, site_block[:, :, 0], class_block
+
+
+def block_zonal_histogram(xoff, yoff, site_block, class_block, value_block=None, inside=None,
+                          nodata_value=None, remove_nodata=False, value_nodata=None,
+                          trajectory_factor=None, extents=False, value_median=False):
+    '''
+    Partial results of one block (see band_zonal_histogram): site_block is the (lines, pixels)
+    block of the site IDs at (xoff, yoff), class_block and value_block the (lines, pixels, n)
+    blocks of the class and value channels (value_block None: no value channels), inside the
+    flat mask of the pixels inside the subset polygons (None: all the pixels).
+    Returns (tables, pixel_counts, value_moments, site_extents) of the block.
+    '''
+    site_ids = site_block.reshape(-1)
+    classes = class_block.reshape(-1, class_block.shape[2])
+    values = None
+    if value_block is not None:
+        values = value_block.reshape(-1, value_block.shape[2])
+    pixels = lines = None
+    if extents is True:
+        lines, pixels = np.indices(site_block.shape)
+        pixels = pixels.reshape(-1) + xoff
+        lines = lines.reshape(-1) + yoff
+
+    selection = inside
+    pixel_counts = np.zeros(2, dtype=np.int64)
+    pixel_counts[0] = len(site_ids) if inside is None else np.count_nonzero(inside)
+    if nodata_value is not None:
+        valid = site_ids != nodata_value
+        if inside is not None:
+            valid &= inside
+        pixel_counts[1] = pixel_counts[0] - np.count_nonzero(valid)
+        if remove_nodata is True:
+            selection = valid
+    if selection is not None:
+        site_ids = site_ids[selection]
+        classes = classes[selection]
+        if values is not None:
+            values = values[selection]
+        if extents is True:
+            pixels = pixels[selection]
+            lines = lines[selection]
+
+    tables = class_histograms(site_ids, classes, trajectory_factor)
+    channel_moments = []
+    if values is not None:
+        channel_moments = value_moments(site_ids, values, value_nodata, value_median)
+    block_extents = None
+    if extents is True:
+        block_extents = site_extents(site_ids, pixels, lines)
+    return tables, pixel_counts, channel_moments, block_extents
+
+
+def tile_cache_key(arrays, settings):
+    '''
+    SHA-1 digest of the contents (data type, shape and bytes) of the input arrays of a tile and of
+    the processing settings (any repr-able value).
+    '''
+    digest = hashlib.sha1(repr(settings).encode("utf-8"))
+    for array in arrays:
+        if array is None:
+            digest.update(b"None")
+            continue
+        array = np.ascontiguousarray(array)
+        digest.update(repr((array.dtype.str, array.shape)).encode("utf-8"))
+        digest.update(array.view(np.uint8).reshape(-1) if array.size else b"")
+    return digest.hexdigest()
+
+
+def tile_cache_file(cache_folder, xoff, yoff):
+    '''
+    Path of the cache file of the block at (xoff, yoff): cache_folder/tile_<x>_<y>.npz.
+    '''
+    return os.path.join(cache_folder, "tile_" + str(xoff) + "_" + str(yoff) + ".npz")
+
+
+def prune_tile_cache(cache_folder, tile_files):
+    '''
+    Deletes the tile files of cache_folder (tile_*.npz) that are not in tile_files, e.g. the tiles
+    of a previous run over another window or with another block_lines.
+    Returns the number of files deleted.
+    '''
+    keep = set(os.path.normcase(os.path.abspath(tile_file)) for tile_file in tile_files)
+    deleted = 0
+    for cache_file in glob.glob(os.path.join(cache_folder, "tile_*.npz")):
+        if os.path.normcase(os.path.abspath(cache_file)) not in keep:
+            os.remove(cache_file)
+            deleted += 1
+    return deleted
+
+
+def _save_tile_cache(cache_file, key, result):
+    tables, pixel_counts, channel_moments, block_extents = result
+    arrays = {"key": np.asarray(key), "pixel_counts": pixel_counts,
+              "n_tables": np.asarray([len(tables), len(channel_moments), block_extents is not None])}
+    for ii, table in enumerate(tables):
+        for name, array in zip(("sites", "classes", "counts"), table):
+            arrays["table_" + str(ii) + "_" + name] = array
+    for ii, moments in enumerate(channel_moments):
+        for name, array in moments.items():
+            if name.startswith("samples_"):
+                array = np.concatenate(array)
+            arrays["moments_" + str(ii) + "_" + name] = array
+    if block_extents is not None:
+        for name, array in block_extents.items():
+            arrays["extents_" + name] = array
+    # Several workers can create the folder at the same time
+    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+    np.savez(cache_file, **arrays)
+
+
+def _load_tile_cache(cache_file, key):
+    if not os.path.exists(cache_file):
+        return None
+    with np.load(cache_file) as cached:
+        if str(cached["key"]) != key:
+            return None
+        n_tables, n_value_channels, has_extents = (int(ii) for ii in cached["n_tables"])
+        tables = [tuple(cached["table_" + str(ii) + "_" + name] for name in ("sites", "classes", "counts"))
+                  for ii in range(n_tables)]
+        channel_moments = []
+        for ii in range(n_value_channels):
+            prefix = "moments_" + str(ii) + "_"
+            moments = {name[len(prefix):]: cached[name] for name in cached.files if name.startswith(prefix)}
+            for name in ("samples_site", "samples_value"):
+                if name in moments:
+                    moments[name] = [moments[name]]
+            channel_moments.append(moments)
+        block_extents = None
+        if has_extents:
+            block_extents = {"site": cached["extents_site"]}
+            block_extents.update((name, cached["extents_" + name]) for name, _ in extent_reductions)
+        return tables, cached["pixel_counts"], channel_moments, block_extents
+
+
+def band_zonal_histogram(input_file, channels, window, block_lines, nodata_value=None,
+                         remove_nodata=False, spans=None, value_channels=None, value_nodata=None,
+                         site_file=None, trajectory_factor=None, extents=False, cache_folder=None,
+                         value_median=False):
+    '''
+    Per site class histograms of channels = [site ID channel, class channel(s)] over
+    window = (x, y, width, height) (None: the whole image), read block by block.
+    With site_file, the site IDs are read from site_file (see site_class_blocks).
+    Returns (tables, pixel_counts, value_moments, site_extents):
+        tables: the (sites, site_classes, counts) table (see zonal_histogram) of every class
+                channel, then of the trajectory codes if trajectory_factor (see class_histograms)
+        pixel_counts: number of pixels read and number of pixels with a NoData site ID
+        value_moments: the per site moments of every channel of value_channels (see
+                       value_moments, with the median samples if value_median), read in the
+                       same pass.
+        site_extents: with extents, the extents of every site (see site_extents), else None
+    With remove_nodata, the pixels with a NoData site ID are not counted.
+    With spans (see vector_mask_tools.polygon_spans), only the pixels inside the subset
+    polygons are read and counted.
+    The blocks are aligned on the image lines (see raster_block_io.iter_windows).
+    With cache_folder, the partial results of every block are stored in
+    cache_folder/tile_<x>_<y>.npz (see tile_cache_file) with the tile_cache_key of the block
+    pixels and settings. At the next run, the blocks whose key did not change are loaded instead
+    of counted again.
+    '''
+    if window is None:
+        window = full_window(input_file)
+    value_channels = list(value_channels or [])
+    n_tables = len(channels) - 1 + (1 if trajectory_factor is not None else 0)
+    tables = [None] * n_tables
+    channel_moments = [None] * len(value_channels)
+    pixel_counts = np.zeros(2, dtype=np.int64)
+    band_extents = None
+    settings = (channels, value_channels, nodata_value, remove_nodata, value_nodata, trajectory_factor, extents,
+                value_median)
+
+    # The value channels are read with their own reader (and data type), window by window
+    blocks = site_class_blocks(input_file, channels, block_lines, window, site_file, align_lines=True)
+    value_blocks = itertools.repeat(None)
+    if value_channels:
+        value_blocks = read_channel_blocks(input_file, value_channels, block_lines, window=window,
+                                           align_lines=True)
+
+    for (xoff, yoff, site_block, class_block), value_block in zip(blocks, value_blocks):
+        if value_block is not None:
+            value_block = value_block[2]
+        inside = None
+        if spans is not None:
+            inside = spans_to_mask(spans, (xoff, yoff, site_block.shape[1], site_block.shape[0])).reshape(-1)
+
+        block_result = None
+        if cache_folder is not None:
+            key = tile_cache_key([site_block, class_block, value_block, inside], (xoff, yoff) + settings)
+            cache_file = tile_cache_file(cache_folder, xoff, yoff)
+            block_result = _load_tile_cache(cache_file, key)
+        if block_result is None:
+            block_result = block_zonal_histogram(xoff, yoff, site_block, class_block, value_block, inside,
+                                                 nodata_value, remove_nodata, value_nodata,
+                                                 trajectory_factor, extents, value_median)
+            if cache_folder is not None:
+                _save_tile_cache(cache_file, key, block_result)
+
+        block_tables, block_counts, block_moments, block_extents = block_result
+        tables = [merge_histograms(table, block_table) for table, block_table in zip(tables, block_tables)]
+        channel_moments = [merge_moments(moments, block_moments)
+                           for moments, block_moments in zip(channel_moments, block_moments)]
+        pixel_counts += block_counts
+        if extents is True:
+            band_extents = merge_extents(band_extents, block_extents)
+
+    if extents is True and band_extents is None:
+        band_extents = site_extents(np.zeros(0), np.zeros(0), np.zeros(0))
+    tables = [zonal_histogram(np.zeros(0), np.zeros(0)) if table is None else table for table in tables]
+    channel_moments = [value_moments(np.zeros(0), np.zeros((0, 1)), median=value_median)[0] if moments is None
+                       else moments for moments in channel_moments]
+    return tables, pixel_counts, channel_moments, band_extents
+
+
+def site_slices(sites):
+    '''
+    Start and end index of every site of a table sorted by site.
+    Returns (site_values, starts, ends).
+    '''
+    site_values, starts = np.unique(sites, return_index=True)
+    ends = np.append(starts[1:], len(sites))
+    return site_values, starts, ends
+
+
+def site_histogram_lines(sites, site_classes, counts):
+    '''
+    One line per site: site ID; number of classes; the classes then their pixel counts, e.g.
+        12;2;1; 3; 250; 17
+    '''
+    lines = []
+    site_values, starts, ends = site_slices(sites)
+    for site_id, first, last in zip(site_values, starts, ends):
+        list_1 = site_classes[first:last].tolist()
+        list_2 = counts[first:last].tolist()
+        list_3 = str(list_1 + list_2).replace(",", ";").replace("[", "").replace("]", "")
+        lines.append(str(site_id) + ";" + str(len(list_1)) + ";" + list_3)
+    return lines
+
+
+def _band_zonal_worker(args):
+    return band_zonal_histogram(*args)
+
+
+def parallel_zonal_histogram(input_file, channels, block_lines, workers, window=None, nodata_value=None,
+                             remove_nodata=False, spans=None, value_channels=None, value_nodata=None,
+                             site_file=None, trajectory_factor=None, extents=False, cache_folder=None,
+                             bands_per_worker=4, value_median=False):
+    '''
+    Per site class histogram over window = (x, y, width, height) (default: the whole image)
+    computed by a pool of worker processes. Every worker opens input_file and reads its own row
+    band, so no image array is sent between processes. The partial tables are merged in band
+    order, so the result does not depend on the number of workers. With workers = 1 the bands
+    are processed in the current process.
+    The band edges are aligned on the multiples of block_lines of the image, so the cached tiles
+    (see band_zonal_histogram) are the same for any number of workers. With cache_folder, the
+    tile files not used by this run are deleted once all the bands are done (see prune_tile_cache).
+    Returns (tables, pixel_counts, value_moments, site_extents), see band_zonal_histogram.
+    '''
+    if window is None:
+        window = full_window(input_file)
+    xoff, yoff, width, height = window
+    bands = row_bands(width, height, int(workers) * bands_per_worker, xoff, yoff, align_lines=block_lines)
+    tasks = [(input_file, channels, band, block_lines, nodata_value, remove_nodata, spans,
+              value_channels, value_nodata, site_file, trajectory_factor, extents, cache_folder, value_median)
+             for band in bands]
+
+    if int(workers) <= 1:
+        partial_results = [_band_zonal_worker(task) for task in tasks]
+    else:
+        with multiprocessing.Pool(int(workers)) as pool:
+            partial_results = pool.map(_band_zonal_worker, tasks, chunksize=1)
+
+    tables = None
+    channel_moments = None
+    all_extents = None
+    pixel_counts = np.zeros(2, dtype=np.int64)
+    for partial_tables, partial_counts, partial_moments, partial_extents in partial_results:
+        if tables is None:
+            tables, channel_moments = partial_tables, partial_moments
+        else:
+            tables = [merge_histograms(table, partial) for table, partial in zip(tables, partial_tables)]
+            channel_moments = [merge_moments(moments, partial)
+                               for moments, partial in zip(channel_moments, partial_moments)]
+        if partial_extents is not None:
+            all_extents = merge_extents(all_extents, partial_extents)
+        pixel_counts += partial_counts
+
+    if cache_folder is not None:
+        tile_files = [tile_cache_file(cache_folder, tile[0], tile[1]) for band in bands
+                      for tile in iter_windows(band[2], band[3], block_lines, None, band[0], band[1], True)]
+        prune_tile_cache(cache_folder, tile_files)
+    return tables, pixel_counts, channel_moments, all_extents